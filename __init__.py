@@ -10,7 +10,9 @@
 from trytond.pool import Pool
 
 from opportunity import NereidUser, Configuration, NereidReview, \
-    CompanySalesTeam, SaleOpportunity, Company
+    CompanySalesTeam, SaleOpportunity, Company, Country
+from outbox import Outbox
+from party import Party, Address, ContactMechanism
 
 
 def register():
@@ -24,5 +26,10 @@ def register():
         CompanySalesTeam,
         SaleOpportunity,
         Company,
+        Country,
+        Outbox,
+        Party,
+        Address,
+        ContactMechanism,
         module='nereid_crm', type_='model',
     )
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    geoip_lookup
+
+    Lazily opened GeoIP database with a LRU cache of the lookups
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import logging
+import threading
+
+from trytond.cache import LRUDict
+from trytond.config import config
+
+try:
+    import pygeoip
+except ImportError:
+    pygeoip = None
+    logging.error("pygeoip is not installed")
+
+
+__all__ = ['GeoIPLookup', 'geoip']
+
+logger = logging.getLogger('nereid_crm.geoip')
+
+
+class GeoIPLookup(object):
+    """
+    Country lookups by IP address.
+
+    The database is only opened on the first lookup, so that importing the
+    module stays cheap and forked workers do not inherit an open file. By
+    default it is accessed through `mmap`, which lets all the workers share
+    the pages of the file cached by the operating system. The results of
+    the lookups are kept in a LRU cache.
+
+    The options are read from the `nereid_crm` section of the trytond
+    configuration unless given explicitly:
+
+    * `geoip_database`: Path of the GeoIP country database
+    * `geoip_cache_mode`: One of `mmap` (default), `memory` or `standard`
+    * `geoip_cache_size`: Number of addresses to cache (default 10000)
+    """
+    default_database = '/usr/share/GeoIP/GeoIP.dat'
+
+    def __init__(self, database=None, cache_mode=None, cache_size=None):
+        self.database = database
+        self.cache_mode = cache_mode
+        self.cache_size = cache_size
+        self._geoip = None
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """
+        Open the database and set up the cache. `_geoip` is set to False
+        if the database is not available.
+        """
+        if self.database is None:
+            self.database = config.get(
+                'nereid_crm', 'geoip_database', default=self.default_database
+            )
+        if self.cache_mode is None:
+            self.cache_mode = config.get(
+                'nereid_crm', 'geoip_cache_mode', default='mmap'
+            )
+        if self.cache_size is None:
+            self.cache_size = config.getint(
+                'nereid_crm', 'geoip_cache_size', default=10000
+            )
+        self._cache = LRUDict(self.cache_size)
+
+        if pygeoip is None:
+            self._geoip = False
+        elif not os.path.isfile(self.database):
+            logger.warning("GeoIP database %s not found", self.database)
+            self._geoip = False
+        else:
+            flags = {
+                'mmap': pygeoip.MMAP_CACHE,
+                'memory': pygeoip.MEMORY_CACHE,
+                'standard': pygeoip.STANDARD,
+            }[self.cache_mode]
+            self._geoip = pygeoip.GeoIP(self.database, flags)
+
+    def country_name_by_addr(self, addr):
+        """
+        Return the name of the country of the IP address or None if it
+        could not be looked up.
+        """
+        if not addr:
+            return None
+
+        with self._lock:
+            if self._geoip is None:
+                self._open()
+            if not self._geoip:
+                return None
+            try:
+                # Pop and set again to keep the most recent lookups
+                result = self._cache[addr] = self._cache.pop(addr)
+                return result
+            except KeyError:
+                pass
+
+        try:
+            result = self._geoip.country_name_by_addr(addr)
+        except Exception:
+            logger.warning("GeoIP lookup failed for %s", addr, exc_info=True)
+            result = None
+
+        with self._lock:
+            self._cache[addr] = result
+        return result
+
+
+#: The lookup shared by the whole process
+geoip = GeoIPLookup()
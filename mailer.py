@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    mailer
+
+    Renderer of the notification mails of the CRM
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import threading
+from weakref import WeakKeyDictionary
+from email.header import Header
+from email.charset import Charset
+
+from flask import current_app, request
+from trytond.cache import LRUDict
+# Registers the body encoding of utf-8 used by render_email, which must be
+# done before the charset of the renderer is built
+import nereid.templating  # noqa
+
+
+__all__ = ['MailRenderer', 'thank_you_mail', 'sale_notification_mail']
+
+
+class MailRenderer(object):
+    """
+    Render a plain text mail from a template, as :func:`nereid.render_email`
+    does, but for many messages.
+
+    The template is looked up and compiled once per worker and application,
+    the MIME headers which do not depend on the message are built once, and
+    the encoded addresses are cached, so that only the body and the subject
+    of each message are rendered. :meth:`render` returns the message as a
+    string, ready to be queued in the outbox.
+
+    :param template_name: Name of the text template
+    """
+    #: The charset of the body, with the encoding nereid registers for utf-8
+    charset = Charset('utf-8')
+
+    #: The headers shared by all the messages
+    mime_headers = (
+        'Content-Type: text/plain; charset="utf-8"\n'
+        'MIME-Version: 1.0\n'
+        'Content-Transfer-Encoding: %s\n' % charset.get_body_encoding()
+    )
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self._templates = WeakKeyDictionary()
+        self._headers = LRUDict(1024)
+        self._lock = threading.Lock()
+
+    def get_template(self):
+        """
+        Return the compiled template for the current application (and
+        website if the templates are prefixed by the website name)
+        """
+        app = current_app._get_current_object()
+        names = [self.template_name]
+        website = None
+        if getattr(app, 'template_prefix_website_name', False):
+            website = request.nereid_website.name
+            names.insert(0, '/'.join([website, self.template_name]))
+
+        templates = self._templates.setdefault(app, {})
+        template = templates.get(website)
+        if template is None:
+            template = templates[website] = \
+                app.jinja_env.get_or_select_template(names)
+        return template
+
+    def encode_header(self, name, value):
+        "Return the header line, encoded like the headers of nereid"
+        key = (name, value)
+        with self._lock:
+            line = self._headers.get(key)
+        if line is None:
+            line = '%s: %s\n' % (
+                name, Header(
+                    unicode(value), 'ISO-8859-1', header_name=name
+                ).encode()
+            )
+            with self._lock:
+                self._headers[key] = line
+        return line
+
+    def render(self, from_email, to, subject, **context):
+        """
+        Return the message rendered with the context as a string
+
+        :param from_email: Email From
+        :param to: Email of the recipients, as a string or a list
+        :param subject: Email subject
+        """
+        if isinstance(to, (list, tuple)):
+            to = ', '.join(to)
+
+        current_app.update_template_context(context)
+        text = self.get_template().render(context)
+
+        return ''.join([
+            self.mime_headers,
+            self.encode_header('Subject', subject),
+            self.encode_header('From', from_email),
+            self.encode_header('To', to),
+            '\n',
+            self.charset.body_encode(text.encode('utf-8')),
+        ])
+
+
+#: The thank you mail sent to a new lead
+thank_you_mail = MailRenderer('crm/emails/lead_thank_you_mail.jinja')
+
+#: The notification of a new lead sent to the sales team
+sale_notification_mail = MailRenderer(
+    'crm/emails/sale_notification_text.jinja'
+)
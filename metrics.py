@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Latency, throughput and query metrics of the CRM handlers
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import heapq
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+from flask import has_request_context
+from flask.signals import request_finished, got_request_exception
+from nereid.templating import LazyRenderer
+from trytond.transaction import Transaction
+
+
+__all__ = [
+    'Histogram', 'MetricsRegistry', 'QueryCounter', 'QueryProfiler',
+    'QueryBudgetExceeded', 'query_budget', 'instrument', 'registry',
+]
+
+
+class Histogram(object):
+    """
+    A cumulative histogram in the style of Prometheus
+
+    :param buckets: The sorted upper bounds of the buckets
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        Return the list of (upper bound, number of observations less or
+        equal), ending with the infinite bound
+        """
+        result, total = [], 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class HandlerMetrics(object):
+    "The metrics of a handler"
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.queries = 0
+        self.query_duration = 0
+        self.latency = Histogram(buckets)
+        #: The slowest statements, as a heap of (duration, statement)
+        self.slowest = []
+
+
+class MetricsRegistry(object):
+    """
+    Collect the metrics of the handlers of a process.
+
+    Each worker process has its own registry, the metrics of all the
+    workers are to be summed by the monitoring.
+    """
+    default_buckets = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    #: Number of the slowest statements kept by handler
+    slowest_size = 10
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.default_buckets
+        self.handlers = {}
+        self._lock = threading.Lock()
+
+    def record(self, handler, duration, profiler, error=False):
+        """
+        Record a request of the handler
+
+        :param duration: The latency in seconds
+        :param profiler: The :class:`QueryProfiler` of the request
+        :param error: True if the request failed
+        """
+        with self._lock:
+            metrics = self.handlers.get(handler)
+            if metrics is None:
+                metrics = self.handlers[handler] = \
+                    HandlerMetrics(self.buckets)
+            metrics.requests += 1
+            metrics.queries += profiler.count
+            metrics.query_duration += profiler.duration
+            if error:
+                metrics.errors += 1
+            metrics.latency.observe(duration)
+            for slow in profiler.slowest:
+                if len(metrics.slowest) < self.slowest_size:
+                    heapq.heappush(metrics.slowest, slow)
+                elif slow > metrics.slowest[0]:
+                    heapq.heapreplace(metrics.slowest, slow)
+
+    def get_slowest(self):
+        """
+        Return a dictionary of the handlers to their slowest statements, as
+        lists of (duration, statement) from the slowest
+        """
+        with self._lock:
+            return dict(
+                (handler, sorted(metrics.slowest, reverse=True))
+                for handler, metrics in self.handlers.iteritems()
+            )
+
+    def clear(self):
+        with self._lock:
+            self.handlers.clear()
+
+    def render(self):
+        "Return the metrics in the text format of Prometheus"
+        lines = []
+        with self._lock:
+            handlers = sorted(self.handlers.items())
+            for name, help_, attribute in (
+                    ('nereid_crm_requests_total',
+                        'Number of requests by handler', 'requests'),
+                    ('nereid_crm_errors_total',
+                        'Number of failed requests by handler', 'errors'),
+                    ('nereid_crm_queries_total',
+                        'Number of SQL queries by handler', 'queries'),
+                    ('nereid_crm_query_duration_seconds_total',
+                        'Time spent in SQL queries by handler',
+                        'query_duration')):
+                lines.append('# HELP %s %s' % (name, help_))
+                lines.append('# TYPE %s counter' % name)
+                for handler, metrics in handlers:
+                    lines.append('%s{handler="%s"} %s' % (
+                        name, handler, getattr(metrics, attribute)
+                    ))
+
+            name = 'nereid_crm_request_duration_seconds'
+            lines.append('# HELP %s Latency of the requests by handler' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for handler, metrics in handlers:
+                for bound, count in metrics.latency.cumulative_counts():
+                    lines.append('%s_bucket{handler="%s",le="%s"} %s' % (
+                        name, handler, bound, count
+                    ))
+                lines.append('%s_sum{handler="%s"} %s' % (
+                    name, handler, metrics.latency.sum
+                ))
+                lines.append('%s_count{handler="%s"} %s' % (
+                    name, handler, metrics.latency.count
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+class QueryCounter(object):
+    """
+    Count the SQL queries executed by the cursor of the transaction, and
+    the time spent in them, while the context manager is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.cursor = None
+        self._previous = None
+
+    def record(self, sql, params, duration):
+        "Record a query"
+        self.count += 1
+        self.duration += duration
+
+    def __enter__(self):
+        cursor = Transaction().cursor
+        if cursor is None:
+            return self
+        execute = cursor.execute
+
+        def counted_execute(sql, params=None):
+            start = time.time()
+            try:
+                return execute(sql, params)
+            finally:
+                self.record(sql, params, time.time() - start)
+
+        self.cursor = cursor
+        # The execute of an enclosing counter, if any
+        self._previous = cursor.__dict__.get('execute')
+        cursor.execute = counted_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.cursor is None:
+            return
+        if self._previous is None:
+            del self.cursor.execute
+        else:
+            self.cursor.execute = self._previous
+        self.cursor = None
+
+
+class QueryProfiler(QueryCounter):
+    """
+    A :class:`QueryCounter` which also keeps the `size` slowest statements,
+    in :attr:`slowest` as a heap of (duration, statement), and all the
+    statements if `keep_all` is set.
+    """
+
+    def __init__(self, size=5, keep_all=False):
+        super(QueryProfiler, self).__init__()
+        self.size = size
+        self.slowest = []
+        self.statements = [] if keep_all else None
+
+    def record(self, sql, params, duration):
+        super(QueryProfiler, self).record(sql, params, duration)
+        if self.statements is not None:
+            self.statements.append(sql)
+        if len(self.slowest) < self.size:
+            heapq.heappush(self.slowest, (duration, sql))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, sql))
+
+
+class QueryBudgetExceeded(AssertionError):
+    "Raised when a block executes more queries than its budget"
+
+
+class query_budget(object):
+    """
+    Context manager failing with :class:`QueryBudgetExceeded` if the
+    block executes more than `max_queries` SQL queries. The profiler is
+    returned by the context manager.
+
+    .. code-block:: python
+
+        with query_budget(20):
+            client.get('/sales/opportunity/leads')
+    """
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.profiler = QueryProfiler(keep_all=True)
+
+    def __enter__(self):
+        return self.profiler.__enter__()
+
+    def __exit__(self, type, value, traceback):
+        self.profiler.__exit__(type, value, traceback)
+        if type is None and self.profiler.count > self.max_queries:
+            raise QueryBudgetExceeded(
+                '%d queries executed, the budget is %d:\n%s' % (
+                    self.profiler.count, self.max_queries,
+                    '\n'.join(self.profiler.statements)
+                )
+            )
+
+
+def _is_error(exc):
+    "Return True unless the exception is a client error, like a 4xx abort"
+    return getattr(exc, 'code', 500) >= 500
+
+
+#: The measures of the handlers which returned a template still to be
+#: rendered, by thread, as a list of (name, start, profiler)
+_pending = threading.local()
+
+
+def _record_pending(error):
+    """
+    Record the measures of the handlers whose templates were rendered for
+    the request, the last started first so that the profilers are removed
+    from the cursor in the reverse order.
+    """
+    pending = getattr(_pending, 'measures', None)
+    end = time.time()
+    while pending:
+        name, start, profiler = pending.pop()
+        profiler.__exit__(None, None, None)
+        registry.record(name, end - start, profiler, error)
+
+
+def _request_finished(sender, response, **extra):
+    _record_pending(response.status_code >= 500)
+
+
+def _request_failed(sender, exception, **extra):
+    _record_pending(_is_error(exception))
+
+
+request_finished.connect(_request_finished)
+got_request_exception.connect(_request_failed)
+
+
+def instrument(func):
+    """
+    Record the latency, the errors and the SQL queries, with the slowest
+    statements, of each call of the handler in the registry, under the
+    name of the function.
+
+    Exceptions are errors unless they are HTTP exceptions of a client
+    error, like the aborts with 4xx status. The result of the handler is
+    returned unchanged, so that the views extending it can still edit a
+    :class:`LazyRenderer`. The measure of such a result ends with the
+    request, once nereid has rendered the template.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        profiler = QueryProfiler()
+        profiler.__enter__()
+        try:
+            result = func(*args, **kwargs)
+        except Exception, exc:
+            profiler.__exit__(None, None, None)
+            registry.record(
+                func.__name__, time.time() - start, profiler, _is_error(exc)
+            )
+            raise
+        if isinstance(result, LazyRenderer) and has_request_context() \
+                and profiler.cursor is not None:
+            if not hasattr(_pending, 'measures'):
+                _pending.measures = []
+            _pending.measures.append((func.__name__, start, profiler))
+            return result
+
+        profiler.__exit__(None, None, None)
+        if isinstance(result, LazyRenderer):
+            status = result.status
+        elif isinstance(result, tuple):
+            status = result[1]
+        else:
+            status = getattr(result, 'status_code', 200)
+        registry.record(
+            func.__name__, time.time() - start, profiler, status >= 500
+        )
+        return result
+    return wrapper
+
+
+#: The registry of the process
+registry = MetricsRegistry()
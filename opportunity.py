@@ -7,45 +7,65 @@
     :copyright: (c) 2012-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
-import os
-from decimal import Decimal
+import re
+import csv
+import time
 import logging
+from contextlib import contextmanager
+from itertools import islice
+from cStringIO import StringIO
+from decimal import Decimal
+from datetime import date, datetime
+from collections import namedtuple
+
+import simplejson as json
 from wtforms import (Form, TextField, SelectField, TextAreaField,
                      validators)
 from flask.ext.wtf import RecaptchaField
 from nereid import (
     request, render_template, login_required, url_for,
     redirect, flash, jsonify, permissions_required,
-    render_email, current_user, route
+    current_user, route, abort, Response
 )
 from nereid.contrib.pagination import Pagination
+from sql import Null, Table
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from sql.functions import Lower, Trim
 from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.config import config
-from trytond.tools import get_smtp_server
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond import backend
+
+from geoip_lookup import geoip
+from mailer import thank_you_mail, sale_notification_mail
+from metrics import instrument, registry
+from pagination import KeysetPagination
+from party import normalize_email
+from ratelimit import lead_rate_limiter
+from tools import invalidate_cache
 
 
 __all__ = [
     'Configuration', 'NereidReview', 'CompanySalesTeam', 'Company',
-    'SaleOpportunity', 'NereidUser',
+    'SaleOpportunity', 'NereidUser', 'Country',
 ]
 __metaclass__ = PoolMeta
 
-geoip = None
-try:
-    from pygeoip import GeoIP
-except ImportError:
-    logging.error("pygeoip is not installed")
-else:
-    # Usual location in Ubuntu
-    path1 = '/usr/share/GeoIP/GeoIP.dat'
+logger = logging.getLogger('nereid_crm')
+
+EMAIL_RE = re.compile(r'^.+@[^.].*\.[a-z]{2,10}$', re.IGNORECASE)
+
 
-    # this is where brew installs it
-    path2 = '/usr/local/Cellar/geoip/1.4.8/share/GeoIP/GeoIP.dat'
-    if os.path.isfile(path1):
-        geoip = GeoIP(path1)
-    elif os.path.isfile(path2):
-        geoip = GeoIP(path2)
+def _json_default(value):
+    "Serialize the dates of the records for simplejson"
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value) + ' is not JSON serializable')
 
 
 class NereidUser:
@@ -60,6 +80,85 @@ class NereidUser:
         'company.employee', 'Employee', select=True,
     )
 
+    _employee_user_cache = Cache('nereid.user.employee_user', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._employee_user_cache.clear()
+        return super(NereidUser, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Company = Pool().get('company.company')
+
+        actions = iter(args)
+        fields_written = set()
+        for users, values in zip(actions, actions):
+            fields_written.update(values)
+        if fields_written & set(['employee', 'active']):
+            cls._employee_user_cache.clear()
+        if fields_written & set(['email', 'active']):
+            Company._sales_team_emails_cache.clear()
+        return super(NereidUser, cls).write(*args)
+
+    @classmethod
+    def delete(cls, users):
+        Company = Pool().get('company.company')
+        cls._employee_user_cache.clear()
+        # The sales team membership is deleted in cascade by the database
+        Company._sales_team_emails_cache.clear()
+        return super(NereidUser, cls).delete(users)
+
+    @classmethod
+    def get_users_for_employees(cls, employees):
+        """
+        Return a dictionary of the employee ids to the nereid user of each
+        employee, or None if the employee has no user.
+
+        The users of the employees which are not cached are found with a
+        single search, and cached until a nereid user is created, deleted
+        or changes employee.
+
+        :param employees: list of employees or employee ids
+        """
+        user_ids, missing = {}, []
+        for employee in set(map(int, filter(None, employees))):
+            user_id = cls._employee_user_cache.get(employee)
+            if user_id is None:
+                missing.append(employee)
+            else:
+                user_ids[employee] = user_id
+
+        if missing:
+            found = {}
+            for user in cls.search(
+                    [('employee', 'in', missing)], order=[('id', 'DESC')]):
+                found[user.employee.id] = user.id
+            for employee in missing:
+                # False is cached for the employees without user
+                user_ids[employee] = cls._employee_user_cache.set(
+                    employee, found.get(employee, False)
+                )
+
+        # The users are browsed together to share their read cache
+        users = dict(
+            (user.id, user)
+            for user in cls.browse(filter(None, set(user_ids.values())))
+        )
+        return dict(
+            (employee, users.get(user_id))
+            for employee, user_id in user_ids.iteritems()
+        )
+
+    @classmethod
+    def get_user_for_employee(cls, employee):
+        """
+        Return the nereid user of the employee, or None
+        """
+        if not employee:
+            return None
+        return cls.get_users_for_employees([employee])[int(employee)]
+
 
 class Configuration:
     "Sale Opportunity configuration"
@@ -73,39 +172,140 @@ class Configuration:
         fields.Char('Sale Opportunity Email')
     )
 
+    #: What to do with a lead whose email is already known: create a new
+    #: party anyway (the default), or attach the lead to the existing party
+    lead_duplicate_policy = fields.Property(
+        fields.Selection([
+            (None, ''),
+            ('create', 'Create a New Party'),
+            ('attach', 'Attach to the Existing Party'),
+        ], 'Duplicate Lead Policy')
+    )
+
+
+class CountryChoice(namedtuple('CountryChoice', ['id', 'rec_name'])):
+    """
+    A lightweight stand in for a country record, as returned by
+    :meth:`Country.get_crm_choices`.
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.rec_name
+
+
+class Country:
+    "Country"
+    __name__ = 'country.country'
+
+    _crm_choices_cache = Cache('country.country.crm_choices', context=False)
+
+    @classmethod
+    def get_crm_choices(cls):
+        """
+        Return the list of (id, rec_name) of all countries in the language
+        of the transaction. The list is cached per database and language.
+        """
+        language = Transaction().language
+        choices = cls._crm_choices_cache.get(language)
+        if choices is not None:
+            return choices
+
+        ids = map(int, cls.search([]))
+        names = dict(
+            (row['id'], row['rec_name'])
+            for row in cls.read(ids, ['rec_name'])
+        )
+        choices = [CountryChoice(id, names[id]) for id in ids]
+        return cls._crm_choices_cache.set(language, choices)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._crm_choices_cache.clear()
+        return super(Country, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._crm_choices_cache.clear()
+        return super(Country, cls).write(*args)
+
+    @classmethod
+    def delete(cls, countries):
+        cls._crm_choices_cache.clear()
+        return super(Country, cls).delete(countries)
+
 
 class Many2OneField(SelectField):
     """
     A select field that works like a many2one field in tryton
 
+    The choices are read with a single batched query and cached per model,
+    domain, user and language for `cache_ttl` seconds. Submitted ids are
+    validated against the cached choices. Call :meth:`clear_cache` when
+    the records are known to have changed.
+
     Additional arguments
 
     :param model: The name of the model
     :param domain: Tryton search domain
     :param validators: wtforms validators
     :param optional: True/False
+    :param cache_ttl: Seconds for which the choices are cached
     """
+    _choices_cache = Cache('nereid_crm.many2one_field', context=False)
+
     def __init__(
         self, label=None, validators=None, model=None, domain=None,
-        optional=False, **kwargs
+        optional=False, cache_ttl=300, **kwargs
     ):
         if model is None:
             raise Exception("Model name cannot be none")
         self.model = model
         self.optional = optional
         self.domain = [] if domain is None else domain
+        self.cache_ttl = cache_ttl
         super(Many2OneField, self).__init__(label, validators, int, **kwargs)
 
+    @classmethod
+    def clear_cache(cls):
+        "Invalidate the cached choices of all Many2OneFields"
+        cls._choices_cache.clear()
+
+    def get_choices(self):
+        """
+        Return the list of (id, rec_name) of the records matching the
+        domain.
+        """
+        Model = Pool().get(self.model)
+
+        key = (
+            self.model, repr(self.domain), Transaction().user,
+            Transaction().language,
+        )
+        cached = self._choices_cache.get(key)
+        if cached is not None:
+            expire, choices = cached
+            if expire > time.time():
+                return choices
+
+        ids = map(int, Model.search(self.domain))
+        names = dict(
+            (row['id'], row['rec_name'])
+            for row in Model.read(ids, ['rec_name'])
+        )
+        choices = [(id, names[id]) for id in ids]
+        self._choices_cache.set(key, (time.time() + self.cache_ttl, choices))
+        return choices
+
     def iter_choices(self):
         '''
         Generates choices for select field.
         '''
-        Model = Pool().get(self.model)
-
         if self.optional:
             yield ('', '', not self.data)
-        for record in Model.search(self.domain):
-            yield (record.id, record.rec_name, record.id == self.data)
+        for id, rec_name in self.get_choices():
+            yield (id, rec_name, id == self.data)
 
     def process_formdata(self, valuelist):
         """
@@ -125,17 +325,28 @@ class Many2OneField(SelectField):
             1. Optional is False.
             2. Optional is True and data is not empty.
         '''
-        Model = Pool().get(self.model)
-
         if self.optional and not self.data:
             # Need not to validate, if field is optional and data is empty
             return
 
-        exists = Model.search(self.domain + [('id', '=', self.data)])
-        if not exists:
+        if self.data not in set(id for id, rec_name in self.get_choices()):
             raise ValueError(self.gettext('Not a valid choice'))
 
 
+class CountryField(Many2OneField):
+    """
+    A Many2OneField for countries which uses the cached country list
+    """
+    def __init__(self, label=None, validators=None, **kwargs):
+        kwargs['model'] = 'country.country'
+        super(CountryField, self).__init__(label, validators, **kwargs)
+
+    def get_choices(self):
+        Country = Pool().get('country.country')
+
+        return Country.get_crm_choices()
+
+
 class ContactUsForm(Form):
     "Simple Contact Us form"
     name = TextField('Name', [validators.Required()])
@@ -149,7 +360,7 @@ class ContactUsForm(Form):
         )
     company = TextField('Company')
     comment = TextAreaField('Comment')
-    country = Many2OneField('Country', model='country.country', optional=True)
+    country = CountryField('Country', optional=True)
     phone = TextField('Phone')
     website = TextField('Website')
 
@@ -165,12 +376,469 @@ class SaleOpportunity:
     )
     detected_country = fields.Char('Detected Country')
 
+    #: The lower cased company, contact name and primary email of the lead,
+    #: copied from its party, address and contact mechanisms so that the
+    #: filters of the leads list do not join them. They are maintained in
+    #: SQL by :meth:`_update_search_columns`.
+    search_company = fields.Char('Search Company', readonly=True)
+    search_name = fields.Char('Search Name', readonly=True)
+    search_email = fields.Char('Search E-Mail', readonly=True)
+
+    #: The number of reviews of the lead, maintained by the create, write
+    #: and delete of the reviews
+    comment_count = fields.Integer('Comments', readonly=True)
+
+    _state_counter_cache = Cache(
+        'sale.opportunity.state_counter', context=False
+    )
+
+    #: The workflow method moving the leads to each state
+    _state_transitions = {
+        'lead': 'lead',
+        'opportunity': 'opportunity',
+        'converted': 'convert',
+        'lost': 'lost',
+        'cancelled': 'cancel',
+    }
+
+    #: The fields of the leads which can be selected in the JSON API, with
+    #: the name of the field read for each of them
+    _api_fields = {
+        'id': 'id',
+        'reference': 'reference',
+        'state': 'state',
+        'description': 'description',
+        'comment': 'comment',
+        'amount': 'amount',
+        'probability': 'probability',
+        'start_date': 'start_date',
+        'end_date': 'end_date',
+        'create_date': 'create_date',
+        'ip_address': 'ip_address',
+        'detected_country': 'detected_country',
+        'party': 'party',
+        'party_name': 'party.name',
+        'email': 'party.email',
+        'contact_name': 'address.name',
+        'employee': 'employee',
+        'employee_name': 'employee.rec_name',
+    }
+
+    #: The columns of the CSV export, as names of :attr:`_api_fields`
+    _csv_columns = [
+        'id', 'party_name', 'email', 'state', 'employee_name', 'amount',
+        'probability',
+    ]
+
+    #: The fields of the comments returned by :meth:`lead_comments`, with
+    #: the name of the field of the review read for each of them
+    _comment_api_fields = {
+        'id': 'id',
+        'title': 'title',
+        'comment': 'comment',
+        'create_date': 'create_date',
+        'nereid_user': 'nereid_user',
+        'author': 'nereid_user.rec_name',
+    }
+
+    #: Columns searched with substring filters in :meth:`all_leads`
+    _trigram_indexes = [
+        ('sale_opportunity', 'search_company'),
+        ('sale_opportunity', 'search_name'),
+        ('sale_opportunity', 'search_email'),
+    ]
+
+    #: The trigram indexes of the party tables, used by the filters before
+    #: the search columns, which are dropped by the update
+    _obsolete_trigram_indexes = [
+        ('party_party', 'name'),
+        ('party_address', 'name'),
+        ('party_contact_mechanism', 'value'),
+    ]
+
+    #: The indexes of the queries of the CRM: the counters and the filters
+    #: by state, the leads of an employee, the keyset pagination by
+    #: creation date and the lookups of the rate limited IP addresses
+    _composite_indexes = [
+        ['state', 'create_date'],
+        ['employee', 'state'],
+        ['company', 'state'],
+        ['create_date', 'id'],
+        ['ip_address'],
+    ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        existing = TableHandler.table_exist(cursor, cls._table)
+        table = TableHandler(cursor, cls, module_name) if existing else None
+        backfill = existing and not table.column_exist('search_company')
+        count_comments = existing and not table.column_exist('comment_count')
+
+        super(SaleOpportunity, cls).__register__(module_name)
+
+        if backfill:
+            cls._fill_new_search_columns()
+        if count_comments and TableHandler.table_exist(cursor, 'nereid_review'):
+            cls._count_comments()
+        cls._create_composite_indexes(module_name, existing)
+        if backend.name() == 'postgresql':
+            cls._create_trigram_indexes(existing)
+
+    @staticmethod
+    def _defer_indexes(existing):
+        """
+        Tell if the indexes of a table are to be deferred, see
+        :meth:`_create_composite_indexes`
+        """
+        return existing and backend.name() == 'postgresql' and \
+            config.getboolean('nereid_crm', 'defer_indexes', default=False)
+
+    @classmethod
+    def _create_composite_indexes(cls, module_name, existing=False):
+        """
+        Create the missing indexes of :attr:`_composite_indexes`.
+
+        Creating an index locks the table against writes for the time of
+        the build, which may be long on a large table in production. When
+        the `defer_indexes` option of the `nereid_crm` section is set, the
+        missing indexes of an existing PostgreSQL table are not created but
+        the `CREATE INDEX CONCURRENTLY` statements building them without
+        the lock are logged, to be run by the administrator. The names are
+        those of Tryton, so the next update finds them.
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        defer = cls._defer_indexes(existing)
+        for columns in cls._composite_indexes:
+            if not defer:
+                table.index_action(columns, 'add')
+                continue
+            index = '%s_%s_index' % (cls._table, '_'.join(columns))
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index,)
+            )
+            if cursor.fetchone():
+                continue
+            logger.warning(
+                'Index %s deferred, create it with: '
+                'CREATE INDEX CONCURRENTLY "%s" ON "%s" (%s)',
+                index, index, cls._table,
+                ', '.join('"%s"' % c for c in columns)
+            )
+
+    @classmethod
+    def _create_trigram_indexes(cls, existing=False):
+        """
+        Create the pg_trgm GIN indexes which let PostgreSQL answer the
+        `like '%...%'` filters of the leads list without scanning the
+        search columns. Nothing is done if the extension cannot be
+        installed. The indexes of an existing table are deferred like the
+        composite indexes.
+        """
+        cursor = Transaction().cursor
+        defer = cls._defer_indexes(existing)
+
+        cursor.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        if not cursor.fetchone():
+            cursor.execute('SAVEPOINT nereid_crm_trgm')
+            try:
+                cursor.execute('CREATE EXTENSION pg_trgm')
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT nereid_crm_trgm')
+                logger.warning(
+                    "The pg_trgm extension could not be created, the leads "
+                    "filters will not be indexed"
+                )
+                return
+            cursor.execute('RELEASE SAVEPOINT nereid_crm_trgm')
+
+        for table, column in cls._trigram_indexes:
+            index = '%s_%s_trgm_index' % (table, column)
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index,)
+            )
+            if cursor.fetchone():
+                continue
+            if defer:
+                logger.warning(
+                    'Index %s deferred, create it with: '
+                    'CREATE INDEX CONCURRENTLY "%s" ON "%s" '
+                    'USING gin ("%s" gin_trgm_ops)',
+                    index, index, table, column
+                )
+                continue
+            cursor.execute(
+                'CREATE INDEX "%s" ON "%s" USING gin ("%s" gin_trgm_ops)'
+                % (index, table, column)
+            )
+
+        for table, column in cls._obsolete_trigram_indexes:
+            cursor.execute(
+                'DROP INDEX IF EXISTS "%s_%s_trgm_index"' % (table, column)
+            )
+
+    @classmethod
+    def _update_search_columns(cls, ids=None, field='id'):
+        """
+        Copy the normalized company, contact name and primary email of the
+        leads whose `field` is in `ids`, or of all the leads, with an
+        UPDATE per slice of ids.
+
+        The primary email is the first active email of the party, as
+        returned by `party.email`.
+
+        :param field: `id`, `party` or `address`
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        party = Party.__table__()
+        address = Address.__table__()
+        mechanism = ContactMechanism.__table__()
+
+        columns = [table.search_company, table.search_name, table.search_email]
+        values = [
+            party.select(
+                Lower(Trim(party.name)), where=party.id == table.party
+            ),
+            address.select(
+                Lower(Trim(address.name)), where=address.id == table.address
+            ),
+            mechanism.select(
+                mechanism.email_normalized,
+                where=(mechanism.party == table.party) &
+                (mechanism.type == 'email') & mechanism.active,
+                order_by=[mechanism.sequence, mechanism.id], limit=1
+            ),
+        ]
+        if ids is None:
+            cursor.execute(*table.update(columns=columns, values=values))
+        else:
+            for sub_ids in grouped_slice(map(int, ids)):
+                cursor.execute(*table.update(
+                    columns=columns, values=values,
+                    where=reduce_ids(getattr(table, field), sub_ids)
+                ))
+
+        # The leads may already have been read
+        invalidate_cache(cls.__name__)
+
+    @classmethod
+    def _count_comments(cls):
+        """
+        Set the comment count of all the leads from their reviews, with a
+        single UPDATE
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        review = Table('nereid_review')
+
+        cursor.execute(*table.update(
+            columns=[table.comment_count],
+            values=[review.select(
+                Count(review.id), where=review.lead == table.id
+            )]
+        ))
+
+    @classmethod
+    def increment_comment_count(cls, leads, count=1):
+        """
+        Add `count`, which may be negative, to the comment count of the
+        leads. The count is incremented in SQL so that concurrent comments
+        are all counted.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = map(int, leads)
+        cursor.execute(*table.update(
+            columns=[table.comment_count],
+            values=[Coalesce(table.comment_count, 0) + count],
+            where=table.id.in_(ids)
+        ))
+
+        # The leads may already have been read
+        invalidate_cache(cls.__name__, ids)
+
+    @staticmethod
+    def default_comment_count():
+        return 0
+
+    def get_comments(self, offset=0, limit=None):
+        """
+        Return the reviews of the lead from the newest. The reviews are not
+        searched when the lead has no comment.
+        """
+        if not self.comment_count:
+            return []
+        Review = Pool().get('nereid.review')
+        return Review.search(
+            [('lead', '=', self.id)], offset=offset, limit=limit,
+            order=[('create_date', 'DESC'), ('id', 'DESC')]
+        )
+
+    @classmethod
+    def _fill_new_search_columns(cls):
+        """
+        Fill the search columns added by the update to an existing table.
+
+        Only a table of at most one batch of leads is filled in the
+        transaction of the update, a larger one is left to the `Backfill
+        Lead Search Columns` cron which runs once after the update and
+        commits each batch.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        batch_size = config.getint(
+            'nereid_crm', 'search_backfill_batch_size', default=1000
+        )
+
+        cursor.execute(*table.select(Count(table.id)))
+        count, = cursor.fetchone()
+        if count <= batch_size:
+            cls.backfill_search_columns(batch_size)
+            return
+        logger.warning(
+            "The search columns of the %d leads are empty, the leads list "
+            "filters will not find them until the 'Backfill Lead Search "
+            "Columns' cron has run", count
+        )
+
+    @classmethod
+    def backfill_search_columns(cls, batch_size=None, commit=False):
+        """
+        Fill the search columns of the existing leads in batches of
+        `batch_size` leads, committing each batch if `commit` is set so
+        that a large table is neither locked nor rewritten in a single
+        transaction. This is the entry point of the cron, which runs once
+        after the module is installed or updated.
+        """
+        if batch_size is None:
+            batch_size = config.getint(
+                'nereid_crm', 'search_backfill_batch_size', default=1000
+            )
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(
+                table.id, where=table.id > last_id,
+                order_by=[table.id.asc], limit=batch_size
+            ))
+            ids = [id for id, in cursor.fetchall()]
+            if not ids:
+                break
+            cls._update_search_columns(ids)
+            if commit:
+                cursor.commit()
+            last_id = ids[-1]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._state_counter_cache.clear()
+        opportunities = super(SaleOpportunity, cls).create(vlist)
+        cls._update_search_columns(opportunities)
+        return opportunities
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'state' in values or 'company' in values:
+                # The state transitions (opportunity, lost, lead, convert
+                # and cancel) all end up writing the state
+                cls._state_counter_cache.clear()
+                break
+        super(SaleOpportunity, cls).write(*args)
+
+        actions = iter(args)
+        to_update = []
+        for records, values in zip(actions, actions):
+            if 'party' in values or 'address' in values:
+                to_update.extend(records)
+        if to_update:
+            cls._update_search_columns(to_update)
+
     @classmethod
+    def delete(cls, opportunities):
+        cls._state_counter_cache.clear()
+        return super(SaleOpportunity, cls).delete(opportunities)
+
+    @classmethod
+    def copy(cls, opportunities, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        # The copied reviews are counted when they are created
+        default.setdefault('comment_count', 0)
+        return super(SaleOpportunity, cls).copy(opportunities, default=default)
+
+    @classmethod
+    def get_state_counter(cls):
+        """
+        Return a dictionary with the number of opportunities in each state
+        for the company of the current user.
+
+        The counts of all the companies are computed with a single grouped
+        query and cached until an opportunity is created, deleted or
+        changes state.
+        """
+        User = Pool().get('res.user')
+
+        counters = cls._state_counter_cache.get(None)
+        if counters is None:
+            cursor = Transaction().cursor
+            table = cls.__table__()
+            cursor.execute(*table.select(
+                table.company, table.state, Count(table.id),
+                group_by=[table.company, table.state]
+            ))
+            counters = {}
+            for company, state, count in cursor.fetchall():
+                counters.setdefault(company, {})[state] = count
+            cls._state_counter_cache.set(None, counters)
+
+        user = User(Transaction().user)
+        company = user.company.id if user.company else None
+        counter = dict.fromkeys(
+            ('lead', 'opportunity', 'converted', 'cancelled', 'lost'), 0
+        )
+        counter.update(counters.get(company, {}))
+        return counter
+
+    @classmethod
+    @instrument
     @route('/sales/opportunity/-new', methods=['POST', 'GET'])
     def new_opportunity(cls):
         """
         Web handler to create a new sale opportunity
+
+        Submissions are rate limited by IP address and email before anything
+        else is done, a response with the status 429 is returned to the
+        clients which exceed the limit.
         """
+        email = normalize_email(request.form.get('email'))
+        if request.method == 'POST' and not lead_rate_limiter.allow(
+                'ip:%s' % request.remote_addr,
+                email and 'email:%s' % email):
+            response = jsonify({
+                "success": False,
+                "message": "Too many requests",
+            })
+            response.status_code = 429
+            return response
+
         if config.has_option('nereid', 're_captcha_public_key'):
             contact_form = ContactUsForm(
                 request.form,
@@ -186,54 +854,11 @@ class SaleOpportunity:
                     "message": "Field validation error",
                     "errors": contact_form.errors,
                 })
-            ContactMech = Pool().get('party.contact_mechanism')
-            Party = Pool().get('party.party')
             Config = Pool().get('sale.configuration')
             sale_config = Config(1)
             contact_data = contact_form.data
-            # Create Party
             company = request.nereid_website.company.id
 
-            if request.remote_addr and geoip:
-                detected_country = geoip.country_name_by_addr(
-                    request.remote_addr
-                )
-            else:
-                detected_country = None
-
-            party, = Party.create([{
-                'name': contact_data.get('company') or contact_data['name'],
-                'addresses': [
-                    ('create', [{
-                        'name': contact_data['name'],
-                    }])
-                ],
-            }])
-
-            if contact_data.get('website'):
-                # Create website as contact mech
-                ContactMech.create([{
-                    'type': 'website',
-                    'party': party.id,
-                    'website': contact_data['website'],
-                }])
-
-            if contact_data.get('phone'):
-                # Create phone as contact mech and assign as phone
-                ContactMech.create([{
-                    'type': 'phone',
-                    'party': party.id,
-                    'other_value': contact_data['phone'],
-                }])
-
-            # Create email as contact mech and assign as email
-            ContactMech.create([{
-                'type': 'email',
-                'party': party.id,
-                'email': contact_data['email'],
-            }])
-
-            # Create sale opportunity
             if not current_user.is_anonymous() and current_user.employee:
                 employee = current_user.employee.id
                 description = 'Created by %s' % \
@@ -241,17 +866,16 @@ class SaleOpportunity:
             else:
                 employee = sale_config.website_employee.id
                 description = 'Created from website'
-            lead, = cls.create([{
-                'party': party.id,
-                'company': company,
-                'employee': employee,
-                'address': party.addresses[0].id,
-                'description': description,
-                'comment': contact_data['comment'],
+
+            contact_data.update({
                 'ip_address': request.remote_addr,
-                'detected_country': detected_country,
-            }])
-            lead.send_notification_mail()
+                'detected_country': geoip.country_name_by_addr(
+                    request.remote_addr
+                ),
+            })
+            lead, = cls.capture_leads(
+                [contact_data], company, employee, description, notify=True
+            )
             if request.is_xhr or request.is_json:
                 return jsonify({
                     "success": True,
@@ -267,8 +891,18 @@ class SaleOpportunity:
 
     def send_notification_mail(self):
         """
-        Send a notification mail to sales department and thank you email to
-        lead whenever new opportunity is created.
+        Queue a notification mail to sales department and thank you email
+        to lead whenever new opportunity is created.
+        """
+        Outbox = Pool().get('nereid.crm.outbox')
+
+        Outbox.queue_mails(self.get_notification_mails())
+
+    def get_notification_mails(self):
+        """
+        Return the notification mail to sales department and the thank you
+        email to lead, as a list of (from_addr, to_addrs, msg) to be
+        queued in the outbox.
         """
         Config = Pool().get('sale.configuration')
 
@@ -276,11 +910,10 @@ class SaleOpportunity:
 
         # Prepare the content for email for lead
         lead_receivers = [self.party.email]
-        lead_message = render_email(
+        lead_message = thank_you_mail.render(
             from_email=sale_config.sale_opportunity_email,
-            to=', '.join(lead_receivers),
+            to=lead_receivers,
             subject="Thank You for your query",
-            text_template='crm/emails/lead_thank_you_mail.jinja',
             lead=self
         )
 
@@ -288,41 +921,419 @@ class SaleOpportunity:
         sale_subject = "[Openlabs CRM] New lead created by %s" % \
             (self.party.name)
 
-        sale_receivers = [
-            member.email for member in self.company.sales_team if member.email
-        ]
+        sale_receivers = self.company.get_sales_team_emails()
 
         sender = config.get('email', 'from')
 
-        sale_message = render_email(
+        sale_message = sale_notification_mail.render(
             from_email=sender,
-            to=', '.join(sale_receivers),
+            to=sale_receivers,
             subject=sale_subject,
-            text_template='crm/emails/sale_notification_text.jinja',
             lead=self
         )
 
-        # Send mail.
-        server = get_smtp_server()
+        # The mails are sent by the outbox cron
+        mails = []
         if sale_receivers:
             # Send to sale department
-            server.sendmail(
-                sender, sale_receivers, sale_message.as_string()
-            )
+            mails.append((sender, sale_receivers, sale_message))
 
         if lead_receivers:
             # Send to lead
-            server.sendmail(
-                sender, lead_receivers, lead_message.as_string()
+            mails.append((sender, lead_receivers, lead_message))
+        return mails
+
+    @staticmethod
+    def _get_lead_party_values(data):
+        """
+        Return the values to create the party of a lead, with its address
+        and contact mechanisms created in the same call.
+
+        :param data: dictionary with the name, email and optionally the
+                     company, phone and website of the lead
+        """
+        contact_mechanisms = [{
+            'type': 'email',
+            'email': data['email'],
+        }]
+        if data.get('website'):
+            contact_mechanisms.append({
+                'type': 'website',
+                'website': data['website'],
+            })
+        if data.get('phone'):
+            contact_mechanisms.append({
+                'type': 'phone',
+                'other_value': data['phone'],
+            })
+        return {
+            'name': data.get('company') or data['name'],
+            'addresses': [
+                ('create', [{
+                    'name': data['name'],
+                }])
+            ],
+            'contact_mechanisms': [('create', contact_mechanisms)],
+        }
+
+    @staticmethod
+    def _attach_lead_contacts(leads):
+        """
+        Add the contact of leads to their existing party and return the id
+        of the address of each lead.
+
+        The address named after the contact is reused, or created, and the
+        phone and website are added unless the party already has them. The
+        addresses and contact mechanisms of all the parties are read and
+        created in batch.
+
+        :param leads: list of (party, data) of the leads, see
+                      :meth:`capture_leads`
+        """
+        pool = Pool()
+        Address = pool.get('party.address')
+        ContactMechanism = pool.get('party.contact_mechanism')
+
+        def normalize(value):
+            return (value or '').strip().lower()
+
+        party_ids = list(set(party.id for party, _ in leads))
+        addresses = {}
+        for address in Address.search(
+                [('party', 'in', party_ids)], order=[('id', 'ASC')]):
+            addresses.setdefault(
+                (address.party.id, normalize(address.name)), address.id
             )
-        server.quit()
+        mechanisms = set(
+            (mechanism.party.id, mechanism.type, normalize(mechanism.value))
+            for mechanism in ContactMechanism.search([
+                ('party', 'in', party_ids),
+                ('type', 'in', ['phone', 'website']),
+            ])
+        )
+
+        to_create, mechanisms_to_create = [], []
+        for party, data in leads:
+            key = (party.id, normalize(data['name']))
+            if key not in addresses:
+                addresses[key] = None
+                to_create.append({'party': party.id, 'name': data['name']})
+            for type_ in ('phone', 'website'):
+                key = (party.id, type_, normalize(data.get(type_)))
+                if data.get(type_) and key not in mechanisms:
+                    mechanisms.add(key)
+                    mechanisms_to_create.append({
+                        'party': party.id,
+                        'type': type_,
+                        'value': data[type_],
+                    })
+        for address in Address.create(to_create):
+            addresses[(address.party.id, normalize(address.name))] = \
+                address.id
+        if mechanisms_to_create:
+            ContactMechanism.create(mechanisms_to_create)
+
+        return [
+            addresses[(party.id, normalize(data['name']))]
+            for party, data in leads
+        ]
+
+    @staticmethod
+    def _check_lead_data(data):
+        """
+        Return the error message if the data of a lead to import is not
+        valid, None otherwise.
+        """
+        if not isinstance(data, dict):
+            return 'Not a record'
+        for key in ('name', 'email'):
+            if not data.get(key):
+                return 'Missing %s' % key
+        for key in (
+                'name', 'email', 'company', 'phone', 'website', 'comment',
+                'ip_address', 'detected_country'):
+            if data.get(key) is not None and \
+                    not isinstance(data[key], basestring):
+                return 'Invalid %s' % key
+        if not EMAIL_RE.match(data['email']):
+            return 'Invalid email address %s' % data['email']
+
+    @classmethod
+    def import_leads(
+        cls, rows, company, employee, description='Imported',
+        chunk_size=None, notify=False
+    ):
+        """
+        Create leads from an iterable of dictionaries with the keys
+        accepted by the contact form (name, email, company, phone, website
+        and comment). The rows are consumed lazily and created by chunks of
+        `chunk_size` with one batched create of the parties, including
+        their addresses and contact mechanisms, and one of the leads.
+
+        Rows which are not valid are skipped and reported, the other rows
+        are still imported. On PostgreSQL, a chunk which fails to be created
+        is rolled back to a savepoint and its rows are reported, on the
+        other backends the error is raised.
+
+        :param rows: iterable of dictionaries, or of exceptions for the
+                     rows which could not be parsed
+        :param company: id of the company of the leads
+        :param employee: id of the employee the leads are assigned to
+        :param notify: queue the notification mails of each lead
+        :return: a tuple with the number of leads created and the list of
+                 (row number, error message)
+        """
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'nereid_crm', 'import_chunk_size', default=500
+            )
+
+        # The SQLite driver of Python 2 commits the transaction before a
+        # SAVEPOINT, so the chunks can only be rolled back on PostgreSQL
+        savepoints = backend.name() == 'postgresql'
+
+        created, errors = 0, []
+        rows = enumerate(rows, 1)
+        while True:
+            chunk, numbers, consumed = [], [], False
+            for number, data in islice(rows, chunk_size):
+                consumed = True
+                if isinstance(data, Exception):
+                    error = unicode(data)
+                else:
+                    error = cls._check_lead_data(data)
+                if error:
+                    errors.append((number, error))
+                else:
+                    chunk.append(data)
+                    numbers.append(number)
+            if not consumed:
+                break
+            if not chunk:
+                continue
+            if not savepoints:
+                created += len(cls.capture_leads(
+                    chunk, company, employee, description, notify
+                ))
+                continue
+            try:
+                with cls._savepoint('nereid_crm_import'):
+                    leads = cls.capture_leads(
+                        chunk, company, employee, description, notify
+                    )
+            except Exception, exc:
+                logger.exception(
+                    "Could not import the rows %d to %d", numbers[0],
+                    numbers[-1]
+                )
+                error = 'Not imported: %s' % (
+                    getattr(exc, 'message', None) or unicode(exc)
+                )
+                errors.extend((number, error) for number in numbers)
+            else:
+                created += len(leads)
+        errors.sort()
+        return created, errors
+
+    @staticmethod
+    @contextmanager
+    def _savepoint(name):
+        """
+        Roll back the statements of the block to a savepoint if it raises,
+        the exception is propagated. Only for PostgreSQL.
+        """
+        cursor = Transaction().cursor
+        cursor.execute('SAVEPOINT "%s"' % name)
+        try:
+            yield
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+            # The records read in the block may have been rolled back
+            invalidate_cache()
+            raise
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+    @classmethod
+    def capture_leads(
+        cls, vlist, company, employee, description, notify=False
+    ):
+        """
+        Create leads with their party, address and contact mechanisms.
+
+        This is the lead intake used by the contact form and the imports,
+        and can be called directly for other sources. Whatever the number of
+        leads, it takes one create of the parties (their addresses and
+        contact mechanisms are created in the same call), one read of the
+        addresses and one create of the leads.
+
+        When the duplicate lead policy of the sale configuration is
+        `attach`, the leads whose email is already known are attached to
+        the existing party, found with one indexed lookup of the normalized
+        emails, instead of creating a new one. The contact name, phone and
+        website of these leads are added to the party, see
+        :meth:`_attach_lead_contacts`, the name of the party is kept.
+
+        :param vlist: list of dictionaries with the name, email and
+                      optionally the company, phone, website, comment,
+                      ip_address and detected_country of each lead
+        :param company: id of the company of the leads
+        :param employee: id of the employee the leads are assigned to
+        :param description: description of the leads
+        :param notify: queue the notification mails of each lead
+        :return: the list of leads created
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Config = pool.get('sale.configuration')
+        Outbox = pool.get('nereid.crm.outbox')
+
+        attach = Config(1).lead_duplicate_policy == 'attach'
+        known = {}
+        if attach:
+            known = ContactMechanism.get_parties_by_email(
+                [data['email'] for data in vlist]
+            )
+
+        # Create the parties of the unknown emails, once per email when
+        # the leads are attached to the existing parties
+        to_create, seen = [], set(known)
+        for data in vlist:
+            key = normalize_email(data['email'])
+            if attach and key in seen:
+                continue
+            seen.add(key)
+            to_create.append(cls._get_lead_party_values(data))
+        new_parties = iter(Party.create(to_create))
+
+        parties, addresses, attached = [], [], []
+        for index, data in enumerate(vlist):
+            key = normalize_email(data['email'])
+            if not attach or key not in known:
+                known[key] = new_party = next(new_parties)
+                addresses.append(
+                    new_party.addresses[0].id if new_party.addresses else None
+                )
+            else:
+                addresses.append(None)
+                attached.append(index)
+            parties.append(known[key])
+
+        if attached:
+            for index, address in zip(attached, cls._attach_lead_contacts(
+                    [(parties[i], vlist[i]) for i in attached])):
+                addresses[index] = address
+
+        leads = cls.create([{
+            'party': party.id,
+            'company': company,
+            'employee': employee,
+            'address': address,
+            'description': description,
+            'comment': data.get('comment'),
+            'ip_address': data.get('ip_address'),
+            'detected_country': data.get('detected_country'),
+        } for party, address, data in zip(parties, addresses, vlist)])
+        if notify:
+            # The mails of all the leads are queued with a single create
+            Outbox.queue_mails([
+                mail for lead in leads
+                for mail in lead.get_notification_mails()
+            ])
+        return leads
+
+    @staticmethod
+    def _parse_import(stream, format_):
+        """
+        Yield the rows of a CSV (with a header line) or JSON lines stream,
+        or the exception raised while parsing a row.
+        """
+        if format_ == 'csv':
+            reader = csv.DictReader(stream)
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error, exc:
+                    yield exc
+                    continue
+                if None in row:
+                    # The values without a column of the header
+                    yield ValueError('More fields than the header')
+                    continue
+                try:
+                    yield dict(
+                        (key, value.decode('utf-8') if value else value)
+                        for key, value in row.iteritems()
+                    )
+                except UnicodeDecodeError, exc:
+                    yield exc
+        else:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError, exc:
+                    yield exc
+
+    @classmethod
+    @instrument
+    @route('/sales/opportunity/-import', methods=['POST'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def bulk_import(cls):
+        """
+        Import leads from a CSV or JSON lines file, posted as the `file`
+        field of a form or as the body of the request.
+
+        The format is given by the `format` argument (`csv` or `jsonl`) or
+        guessed from the content type. Leads are assigned to the current
+        user, or to the website employee.
+        """
+        Config = Pool().get('sale.configuration')
+
+        if 'file' in request.files:
+            stream = request.files['file'].stream
+            content_type = request.files['file'].content_type
+        else:
+            stream = request.stream
+            content_type = request.mimetype
+        format_ = request.args.get('format')
+        if format_ is None:
+            format_ = 'csv' if 'csv' in (content_type or '') else 'jsonl'
+        if format_ not in ('csv', 'jsonl'):
+            abort(400)
+
+        if current_user.employee:
+            employee = current_user.employee.id
+        else:
+            employee = Config(1).website_employee.id
+
+        created, errors = cls.import_leads(
+            cls._parse_import(stream, format_),
+            request.nereid_website.company.id, employee,
+            description='Imported by %s' % current_user.display_name,
+            notify=request.args.get('notify', type=int) == 1,
+        )
+        return jsonify({
+            'success': not errors,
+            'created': created,
+            'errors': [
+                {'row': number, 'message': message}
+                for number, message in errors
+            ],
+        })
 
     @classmethod
+    @instrument
     @route('/sales/opportunity/-thanks', methods=['GET'])
     def new_opportunity_thanks(cls):
         "A thanks template rendered"
         return render_template('crm/thanks.jinja')
 
+    @instrument
     @login_required
     @route(
         '/sales/opportunity/lead-revenue/<int:active_id>',
@@ -335,13 +1346,7 @@ class SaleOpportunity:
         """
         NereidUser = Pool().get('nereid.user')
 
-        nereid_user = NereidUser.search(
-            [('employee', '=', self.employee.id)], limit=1
-        )
-        if nereid_user:
-            employee = nereid_user[0]
-        else:
-            employee = None
+        employee = NereidUser.get_user_for_employee(self.employee)
 
         if request.method == 'POST':
             self.write([self], {
@@ -358,6 +1363,7 @@ class SaleOpportunity:
         )
 
     @classmethod
+    @instrument
     @route('/sales')
     @login_required
     @permissions_required(['sales.admin'])
@@ -367,35 +1373,68 @@ class SaleOpportunity:
         """
         Country = Pool().get('country.country')
 
-        countries = Country.search([])
+        countries = Country.get_crm_choices()
 
-        counter = {}
-        for state in ('lead', 'opportunity', 'converted', 'cancelled', 'lost'):
-            counter[state] = cls.search([('state', '=', state)], count=True)
         return render_template(
-            'crm/home.jinja', counter=counter, countries=countries
+            'crm/home.jinja', counter=cls.get_state_counter(),
+            countries=countries
         )
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-assign', methods=['POST'])
     @permissions_required(['sales.admin'])
     def assign_lead(self):
         "Change the employee on lead"
         NereidUser = Pool().get('nereid.user')
+        Party = Pool().get('party.party')
 
-        new_assignee = NereidUser(int(request.form['user']))
-        if self.employee.id == new_assignee.employee.id:
-            flash("Lead already assigned to %s" % new_assignee.party.name)
+        # Only read the fields needed instead of instantiating the user
+        new_assignee, = NereidUser.read(
+            [int(request.form['user'])], ['employee', 'party']
+        )
+        party, = Party.read([new_assignee['party']], ['name'])
+        if self.employee.id == new_assignee['employee']:
+            flash("Lead already assigned to %s" % party['name'])
             return redirect(request.referrer)
 
         self.write([self], {
-            'employee': new_assignee.employee.id
+            'employee': new_assignee['employee']
         })
 
-        flash("Lead assigned to %s" % new_assignee.party.name)
+        flash("Lead assigned to %s" % party['name'])
         return redirect(request.referrer)
 
+    @staticmethod
+    def _get_leads_filter_domain(filters):
+        """
+        Return the domain of the leads matching the filters of the leads
+        list: company, name, email (substrings) and state.
+
+        :param filters: dictionary of the filters
+        """
+        filter_domain = []
+
+        # The search columns are lower cased
+        for name, field in (
+                ('company', 'search_company'),
+                ('name', 'search_name'),
+                ('email', 'search_email')):
+            value = filters.get(name, None)
+            if value:
+                filter_domain.append(
+                    (field, 'like', '%%%s%%' % value.strip(' ').lower())
+                )
+
+        state = filters.get('state', None)
+        if state:
+            filter_domain.append(
+                ('state', '=', '%s' % state)
+            )
+        return filter_domain
+
     @classmethod
+    @instrument
     @route('/sales/opportunity/leads', methods=['GET'])
     @route('/sales/opportunity/leads/<int:page>', methods=['GET'])
     @login_required
@@ -403,63 +1442,258 @@ class SaleOpportunity:
     def all_leads(cls, page=1):
         """
         All leads captured
+
+        The leads are paginated by page number, or with keyset pagination
+        from the newest to the oldest lead when a `cursor` argument is
+        given. In that case the total count is only computed when a `count`
+        argument is given.
         """
         Country = Pool().get('country.country')
+        NereidUser = Pool().get('nereid.user')
 
-        countries = Country.search([])
-        filter_domain = []
+        countries = Country.get_crm_choices()
+        filter_domain = cls._get_leads_filter_domain(request.args)
 
-        company = request.args.get('company', None)
-        if company:
-            filter_domain.append(('party.name', 'ilike', '%%%s%%' % company))
+        if 'cursor' in request.args:
+            # Keyset pagination, the cost of a page does not depend on its
+            # depth. An empty cursor is the first page.
+            try:
+                leads = KeysetPagination(
+                    cls, filter_domain, request.args['cursor'], 10,
+                    with_count='count' in request.args
+                )
+            except ValueError:
+                abort(400)
+        else:
+            leads = Pagination(cls, filter_domain, page, 10)
 
-        name = request.args.get('name', None)
-        if name:
-            filter_domain.append(
-                ('address.name', 'ilike', '%%%s%%' % name)
-            )
+        # The nereid users of the employees of the page, by employee id
+        assignees = NereidUser.get_users_for_employees(
+            [lead.employee.id for lead in leads.items() if lead.employee]
+        )
+        return render_template(
+            'crm/leads.jinja', leads=leads, countries=countries,
+            assignees=assignees
+        )
 
-        email = request.args.get('email', None)
-        if email:
-            filter_domain.append(
-                ('address.email', 'ilike', '%%%s%%' % email)
+    @classmethod
+    def read_api_fields(cls, ids, names):
+        """
+        Return the list of dictionaries of the given API fields of the
+        leads, read with one batched read.
+
+        :param ids: list of lead ids
+        :param names: list of names of :attr:`_api_fields`
+        """
+        fields_names = [cls._api_fields[name] for name in names]
+        rows = dict(
+            (row['id'], row) for row in cls.read(ids, fields_names + ['id'])
+        )
+        return [
+            dict(
+                (name, rows[id][field_name])
+                for name, field_name in zip(names, fields_names)
+            ) for id in ids if id in rows
+        ]
+
+    @classmethod
+    def stream_leads(cls, domain, read, chunk_size=None):
+        """
+        Return a generator of the results of `read` for chunks of the ids of
+        the leads matching the domain, in the order of the ids.
+
+        The generator can be consumed after the transaction of the request
+        is closed, like in a streamed response, it then reads the leads in
+        its own readonly transaction. So this method must be called while
+        the transaction of the request is open, not from the body of the
+        response.
+
+        :param read: a function called with each list of lead ids
+        :param chunk_size: number of leads of each chunk, from the
+                           `stream_chunk_size` option by default
+        """
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'nereid_crm', 'stream_chunk_size', default=1000
             )
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def read_chunks():
+            last_id = 0
+            while True:
+                ids = map(int, cls.search(
+                    domain + [('id', '>', last_id)],
+                    order=[('id', 'ASC')], limit=chunk_size
+                ))
+                if not ids:
+                    break
+                yield read(ids)
+                last_id = ids[-1]
+
+        def generate():
+            if Transaction().cursor is not None:
+                for result in read_chunks():
+                    yield result
+                return
+            with Transaction().start(
+                    database_name, user, readonly=True, context=context):
+                for result in read_chunks():
+                    yield result
+
+        return generate()
 
-        state = request.args.get('state', None)
-        if state:
-            filter_domain.append(
-                ('state', '=', '%s' % state)
+    @classmethod
+    @instrument
+    @route('/sales/opportunity/leads.json', methods=['GET'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def leads_json(cls):
+        """
+        The leads as JSON, with the filters of :meth:`all_leads`.
+
+        The `fields` argument is the comma separated list of the fields to
+        return among :attr:`_api_fields` (all by default). The leads are
+        returned from the newest by pages of `per_page` (100 at most), or
+        all of them as a stream of JSON lines, from the oldest, if the
+        `stream` argument is given.
+        """
+        names = request.args.get('fields')
+        names = names.split(',') if names else sorted(cls._api_fields)
+        if not set(names) <= set(cls._api_fields):
+            abort(400)
+        domain = cls._get_leads_filter_domain(request.args)
+
+        if 'stream' in request.args:
+            chunks = cls.stream_leads(
+                domain, lambda ids: cls.read_api_fields(ids, names)
             )
 
-        leads = Pagination(cls, filter_domain, page, 10)
-        return render_template(
-            'crm/leads.jinja', leads=leads, countries=countries
-        )
+            def generate():
+                for rows in chunks:
+                    for row in rows:
+                        yield json.dumps(row, default=_json_default) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson')
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
+        ids = map(int, cls.search(
+            domain, offset=(page - 1) * per_page, limit=per_page,
+            order=[('create_date', 'DESC'), ('id', 'DESC')]
+        ))
+        return Response(json.dumps({
+            'page': page,
+            'per_page': per_page,
+            'items': cls.read_api_fields(ids, names),
+        }, default=_json_default), mimetype='application/json')
+
+    @classmethod
+    def _get_csv_lines(cls, ids):
+        """
+        Return the CSV lines of the leads, encoded in UTF-8
+        """
+        output = StringIO()
+        writer = csv.writer(output)
+        for row in cls.read_api_fields(ids, cls._csv_columns):
+            writer.writerow([
+                unicode(row[name]).encode('utf-8')
+                if row[name] is not None else ''
+                for name in cls._csv_columns
+            ])
+        return output.getvalue()
 
+    @classmethod
+    @instrument
+    @route('/sales/opportunity/leads.csv', methods=['GET'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def export_leads(cls):
+        """
+        Export the leads matching the filters of :meth:`all_leads` as CSV.
+
+        The file is streamed, the leads are read by chunks of ids so that
+        the memory used does not depend on the number of leads.
+        """
+        domain = cls._get_leads_filter_domain(request.args)
+        chunks = cls.stream_leads(domain, cls._get_csv_lines)
+
+        def generate():
+            output = StringIO()
+            csv.writer(output).writerow(cls._csv_columns)
+            yield output.getvalue()
+            for lines in chunks:
+                yield lines
+
+        return Response(generate(), mimetype='text/csv', headers={
+            'Content-Disposition': 'attachment; filename=leads.csv',
+        })
+
+    @instrument
     @route('/sales/opportunity/lead/<int:active_id>')
     @login_required
     @permissions_required(['sales.admin'])
     def admin_lead(self):
         """
         Lead
+
+        Only the latest comments, `lead_comments_per_page` (10 by default),
+        are rendered with the lead, the older ones are to be loaded from
+        :meth:`lead_comments`.
         """
         NereidUser = Pool().get('nereid.user')
         Country = Pool().get('country.country')
 
-        countries = Country.search([])
-        nereid_users = NereidUser.search(
-            [('employee', '=', self.employee.id)], limit=1
-        )
-        if nereid_users:
-            employee = nereid_users[0]
-        else:
-            employee = None
+        countries = Country.get_crm_choices()
+        employee = NereidUser.get_user_for_employee(self.employee)
+        comments = self.get_comments(limit=config.getint(
+            'nereid_crm', 'lead_comments_per_page', default=10
+        ))
         return render_template(
             'crm/admin-lead.jinja', lead=self, employee=employee,
-            countries=countries
+            countries=countries, comments=comments
+        )
+
+    @instrument
+    @route('/sales/opportunity/lead/<int:active_id>/comments.json')
+    @login_required
+    @permissions_required(['sales.admin'])
+    def lead_comments(self):
+        """
+        The comments of the lead as JSON, from the newest, by pages of
+        `per_page` (100 at most).
+        """
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
+
+        items = []
+        comments = self.get_comments(
+            offset=(page - 1) * per_page, limit=per_page
         )
+        if comments:
+            Review = Pool().get('nereid.review')
+            names = sorted(self._comment_api_fields)
+            fields_names = [self._comment_api_fields[n] for n in names]
+            rows = dict(
+                (row['id'], row)
+                for row in Review.read(map(int, comments), fields_names)
+            )
+            items = [
+                dict(
+                    (name, rows[comment.id][field_name])
+                    for name, field_name in zip(names, fields_names)
+                ) for comment in comments
+            ]
+        return Response(json.dumps({
+            'page': page,
+            'per_page': per_page,
+            'count': self.comment_count or 0,
+            'items': items,
+        }, default=_json_default), mimetype='application/json')
 
     @classmethod
+    @instrument
     @route('/sales/opportunity/lead/add-comment', methods=['POST'])
     @login_required
     @permissions_required(['sales.admin'])
@@ -485,6 +1719,7 @@ class SaleOpportunity:
             })
         return redirect(request.referrer + '#tab-comment')
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-opportunity', methods=["POST"])
     @permissions_required(['sales.admin'])
@@ -500,6 +1735,7 @@ class SaleOpportunity:
             })
         return redirect(request.referrer)
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-lost', methods=["POST"])
     @permissions_required(['sales.admin'])
@@ -515,6 +1751,7 @@ class SaleOpportunity:
             })
         return redirect(request.referrer)
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-lead', methods=["POST"])
     @permissions_required(['sales.admin'])
@@ -530,6 +1767,7 @@ class SaleOpportunity:
             })
         return redirect(request.referrer)
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-convert', methods=["POST"])
     @permissions_required(['sales.admin'])
@@ -545,6 +1783,7 @@ class SaleOpportunity:
             })
         return redirect(request.referrer)
 
+    @instrument
     @login_required
     @route('/lead-<int:active_id>/-cancel', methods=["POST"])
     @permissions_required(['sales.admin'])
@@ -560,6 +1799,235 @@ class SaleOpportunity:
             })
         return redirect(request.referrer)
 
+    @classmethod
+    def _get_bulk_lead_ids(cls, data):
+        """
+        Return the ids of the leads a bulk action is applied to.
+
+        :param data: dictionary with either the list of lead `ids` or the
+                     `filters` of the leads list
+        """
+        if data.get('ids') is not None:
+            return map(int, data['ids'])
+        filters = data.get('filters') or {}
+        if not isinstance(filters, dict):
+            raise TypeError('The filters must be an object')
+        return map(int, cls.search(
+            cls._get_leads_filter_domain(filters), order=[('id', 'ASC')]
+        ))
+
+    @classmethod
+    def transition_leads(cls, ids, state, chunk_size=None):
+        """
+        Move the leads to the state with its workflow method, applied to
+        chunks of `chunk_size` leads.
+
+        :param ids: list of lead ids
+        :param state: the target state
+        :return: a dictionary of the lead ids to the result of the
+                 transition: `done`, `unchanged` if the lead was already in
+                 the state, `invalid` if the workflow does not allow the
+                 transition or `missing` if the lead does not exist
+        """
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'nereid_crm', 'bulk_chunk_size', default=500
+            )
+        transition = getattr(cls, cls._state_transitions[state])
+
+        results = {}
+        for i in xrange(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            leads = cls.search([('id', 'in', chunk)])
+            to_move = []
+            for lead in leads:
+                if lead.state == state:
+                    results[lead.id] = 'unchanged'
+                elif (lead.state, state) in cls._transitions:
+                    results[lead.id] = 'done'
+                    to_move.append(lead)
+                else:
+                    results[lead.id] = 'invalid'
+            for id in chunk:
+                results.setdefault(id, 'missing')
+            if to_move:
+                transition(to_move)
+        return results
+
+    @classmethod
+    @instrument
+    @route('/sales/opportunity/-bulk-transition', methods=['POST'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def bulk_transition(cls):
+        """
+        Move many leads to a state in one request.
+
+        The JSON body gives the target `state` and either the list of lead
+        `ids` or the `filters` of the leads list. The result of each lead
+        is returned by id, see :meth:`transition_leads`.
+        """
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            abort(400)
+        state = data.get('state')
+        if state not in cls._state_transitions:
+            response = jsonify({
+                'success': False,
+                'message': 'Invalid state %s' % state,
+            })
+            response.status_code = 400
+            return response
+
+        try:
+            ids = cls._get_bulk_lead_ids(data)
+        except (TypeError, ValueError):
+            abort(400)
+
+        try:
+            results = cls.transition_leads(ids, state)
+        except UserError, exc:
+            # Nothing is done if any of the transitions failed
+            Transaction().cursor.rollback()
+            response = jsonify({
+                'success': False,
+                'message': exc.message,
+            })
+            response.status_code = 400
+            return response
+
+        counts = dict.fromkeys(('done', 'unchanged', 'invalid', 'missing'), 0)
+        for result in results.itervalues():
+            counts[result] += 1
+        return jsonify({
+            'success': True,
+            'counts': counts,
+            'results': results,
+        })
+
+    @classmethod
+    def reassign_leads(cls, ids, employees, from_employee=None):
+        """
+        Assign the leads to the employees, split evenly between them in the
+        order of the leads. The employee of each share of the leads is set
+        with a single write.
+
+        :param ids: list of lead ids
+        :param employees: list of the ids of the new employees
+        :param from_employee: only reassign the leads of this employee
+        :return: a dictionary of the employee ids to the number of leads
+                 assigned to them, empty if there are no employees
+        """
+        if not employees:
+            return {}
+
+        domain = [('id', 'in', ids)]
+        if from_employee is not None:
+            domain.append(('employee', '=', from_employee))
+        leads = cls.search(domain, order=[('id', 'ASC')])
+
+        counts = {}
+        employees = [
+            e for i, e in enumerate(employees) if e not in employees[:i]
+        ]
+        share, remainder = divmod(len(leads), len(employees))
+        start = 0
+        for index, employee in enumerate(employees):
+            end = start + share + (1 if index < remainder else 0)
+            if end > start:
+                cls.write(leads[start:end], {'employee': employee})
+            counts[employee] = end - start
+            start = end
+        return counts
+
+    @classmethod
+    @instrument
+    @route('/sales/opportunity/-bulk-assign', methods=['POST'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def bulk_assign(cls):
+        """
+        Reassign many leads in one request.
+
+        The JSON body gives the ids of the nereid `users` to assign the
+        leads to, split evenly if there are several, either the list of
+        lead `ids` or the `filters` of the leads list and optionally
+        `from_user` to only move the leads of that user.
+        """
+        NereidUser = Pool().get('nereid.user')
+
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            abort(400)
+        try:
+            ids = cls._get_bulk_lead_ids(data)
+            users = []
+            for user in map(int, data.get('users') or []):
+                if user not in users:
+                    users.append(user)
+            from_user = data.get('from_user')
+            if from_user is not None:
+                from_user = int(from_user)
+        except (TypeError, ValueError):
+            abort(400)
+
+        # The users which do not exist have no employee
+        employees = dict(
+            (user.id, user.employee and user.employee.id)
+            for user in NereidUser.search([
+                ('id', 'in', [u for u in users + [from_user] if u is not None]),
+            ])
+        )
+        if not users or not all(
+                employees.get(user) for user in users + [from_user]
+                if user is not None):
+            response = jsonify({
+                'success': False,
+                'message': 'The leads must be assigned to employees',
+            })
+            response.status_code = 400
+            return response
+
+        counts = cls.reassign_leads(
+            ids, [employees[user] for user in users],
+            employees[from_user] if from_user is not None else None
+        )
+        # Users of the same employee share its leads
+        assigned = dict((user, counts[employees[user]]) for user in users)
+        return jsonify({
+            'success': True,
+            'count': sum(counts.values()),
+            'assigned': assigned,
+        })
+
+    @classmethod
+    @route('/sales/-metrics', methods=['GET'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def metrics(cls):
+        """
+        The metrics of the handlers of the CRM in this worker process, in
+        the text format of Prometheus
+        """
+        return Response(
+            registry.render(), mimetype='text/plain; version=0.0.4'
+        )
+
+    @classmethod
+    @route('/sales/-metrics/queries', methods=['GET'])
+    @login_required
+    @permissions_required(['sales.admin'])
+    def query_profile(cls):
+        """
+        The slowest SQL statements of each handler in this worker process
+        """
+        return jsonify(dict(
+            (handler, [
+                {'duration': duration, 'statement': statement}
+                for duration, statement in slowest
+            ]) for handler, slowest in registry.get_slowest().iteritems()
+        ))
+
 
 class Company:
     "Company"
@@ -570,6 +2038,40 @@ class Company:
         'company', 'nereid_user', 'Sales Team'
     )
 
+    _sales_team_emails_cache = Cache(
+        'company.company.sales_team_emails', context=False
+    )
+
+    def get_sales_team_emails(self):
+        """
+        Return the list of the emails of the active members of the sales
+        team.
+
+        The list is built with a single query joining the team to the users
+        and cached until the team or the email of a user changes.
+        """
+        pool = Pool()
+        SalesTeam = pool.get('company.company-nereid.user-sales')
+        NereidUser = pool.get('nereid.user')
+
+        emails = self._sales_team_emails_cache.get(self.id)
+        if emails is not None:
+            return list(emails)
+
+        cursor = Transaction().cursor
+        team = SalesTeam.__table__()
+        user = NereidUser.__table__()
+        cursor.execute(*team.join(
+            user, condition=team.nereid_user == user.id
+        ).select(
+            user.email,
+            where=(team.company == self.id) & user.active &
+            (user.email != Null),
+            order_by=[team.id.asc]
+        ))
+        emails = [email for email, in cursor.fetchall() if email]
+        return list(self._sales_team_emails_cache.set(self.id, emails))
+
 
 class CompanySalesTeam(ModelSQL):
     "Sales Team"
@@ -585,6 +2087,24 @@ class CompanySalesTeam(ModelSQL):
         ondelete='CASCADE', required=True, select=True,
     )
 
+    @classmethod
+    def create(cls, vlist):
+        Company = Pool().get('company.company')
+        Company._sales_team_emails_cache.clear()
+        return super(CompanySalesTeam, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Company = Pool().get('company.company')
+        Company._sales_team_emails_cache.clear()
+        return super(CompanySalesTeam, cls).write(*args)
+
+    @classmethod
+    def delete(cls, members):
+        Company = Pool().get('company.company')
+        Company._sales_team_emails_cache.clear()
+        return super(CompanySalesTeam, cls).delete(members)
+
 
 class NereidReview:
     """
@@ -593,5 +2113,58 @@ class NereidReview:
     __name__ = "nereid.review"
 
     lead = fields.Many2One(
-        'sale.opportunity', 'Sale Opportunity Lead'
+        'sale.opportunity', 'Sale Opportunity Lead', select=True
     )
+
+    @staticmethod
+    def _update_comment_counts(deltas):
+        """
+        Update the comment count of the leads
+
+        :param deltas: dictionary of the lead ids to the number of reviews
+                       added, or removed if negative
+        """
+        Opportunity = Pool().get('sale.opportunity')
+
+        leads_by_delta = {}
+        for lead, delta in deltas.iteritems():
+            if lead is not None and delta:
+                leads_by_delta.setdefault(delta, []).append(lead)
+        for delta, leads in leads_by_delta.iteritems():
+            Opportunity.increment_comment_count(leads, delta)
+
+    @staticmethod
+    def _count_by_lead(reviews, sign=1):
+        "Return a dictionary of the lead ids to `sign` times their reviews"
+        deltas = {}
+        for review in reviews:
+            lead = review.lead.id if review.lead else None
+            deltas[lead] = deltas.get(lead, 0) + sign
+        return deltas
+
+    @classmethod
+    def create(cls, vlist):
+        reviews = super(NereidReview, cls).create(vlist)
+        cls._update_comment_counts(cls._count_by_lead(reviews))
+        return reviews
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        moved = []
+        for reviews, values in zip(actions, actions):
+            if 'lead' in values:
+                moved.extend(reviews)
+        deltas = cls._count_by_lead(moved, -1)
+
+        super(NereidReview, cls).write(*args)
+
+        for lead, delta in cls._count_by_lead(moved).iteritems():
+            deltas[lead] = deltas.get(lead, 0) + delta
+        cls._update_comment_counts(deltas)
+
+    @classmethod
+    def delete(cls, reviews):
+        deltas = cls._count_by_lead(reviews, -1)
+        super(NereidReview, cls).delete(reviews)
+        cls._update_comment_counts(deltas)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+    outbox
+
+    Transactional outbox for the emails sent by the CRM
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+from datetime import datetime, timedelta
+from email.message import Message
+
+from trytond.model import ModelSQL, fields
+from trytond.config import config
+from trytond.transaction import Transaction
+from trytond import backend
+
+from smtp_pool import get_pool
+from tools import invalidate_cache
+
+
+__all__ = ['Outbox']
+
+logger = logging.getLogger('nereid_crm.outbox')
+
+
+class Outbox(ModelSQL):
+    """
+    CRM Mail Outbox
+
+    Messages are rendered and stored in the same transaction as the lead
+    which triggered them, and are delivered later by the cron which calls
+    :meth:`send_all`. Failed deliveries are retried with an exponential
+    backoff until `outbox_max_attempts` is reached. Delivery reuses the
+    connections of the process wide SMTP connection pool.
+
+    The mails being delivered are claimed in the `sending` state, with
+    `next_attempt` as the end of the claim, so that concurrent crons do
+    not send them twice.
+
+    The sent and failed mails are deleted by the daily cron which calls
+    :meth:`purge`, once they are older than `outbox_sent_retention_days`
+    (7 by default) and `outbox_failed_retention_days` (30 by default).
+    """
+    __name__ = 'nereid.crm.outbox'
+
+    from_addr = fields.Char('From Address', required=True, readonly=True)
+    to_addrs = fields.Text('To Addresses', required=True, readonly=True)
+    msg = fields.Text('Message', required=True, readonly=True)
+    state = fields.Selection([
+        ('outbox', 'Outbox'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    #: Number of failed delivery attempts
+    attempts = fields.Integer('Attempts', required=True, readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True, select=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'outbox'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def queue_mail(cls, from_addr, to_addrs, msg):
+        """
+        Add the message to the outbox
+
+        :param from_addr: Address from which the email is sent
+        :param to_addrs: A string or a list of string addresses
+        :param msg: RFC822 Message as a string or an instance of Message
+        """
+        return cls.queue_mails([(from_addr, to_addrs, msg)])
+
+    @classmethod
+    def queue_mails(cls, mails):
+        """
+        Add the messages to the outbox with a single create
+
+        :param mails: list of (from_addr, to_addrs, msg) as taken by
+                      :meth:`queue_mail`
+        """
+        now = datetime.utcnow()
+        vlist = []
+        for from_addr, to_addrs, msg in mails:
+            if isinstance(to_addrs, (list, tuple)):
+                to_addrs = ','.join(to_addrs)
+
+            if isinstance(msg, Message):
+                msg = msg.as_string()
+
+            vlist.append({
+                'from_addr': from_addr,
+                'to_addrs': to_addrs,
+                'msg': msg,
+                'next_attempt': now,
+            })
+        return cls.create(vlist)
+
+    @staticmethod
+    def get_retry_delay(attempts):
+        """
+        Return the backoff before the next attempt of a mail which has
+        already failed `attempts` times.
+        """
+        delay = config.getint('nereid_crm', 'outbox_retry_delay', default=60)
+        return timedelta(seconds=delay * 2 ** (attempts - 1))
+
+    @classmethod
+    def claim_batch(cls, batch_size):
+        """
+        Claim and return up to `batch_size` mails due for delivery.
+
+        The mails are claimed for `outbox_claim_timeout` seconds (300 by
+        default), after which a mail still in the `sending` state, whose
+        worker was killed, is claimed again. On PostgreSQL the mails locked
+        by another cron are skipped, elsewhere only the mails which are
+        still claimable when they are updated are returned.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        now = datetime.utcnow()
+        claimed_until = now + timedelta(seconds=config.getint(
+            'nereid_crm', 'outbox_claim_timeout', default=300
+        ))
+        claimable = table.state.in_(['outbox', 'sending']) & \
+            (table.next_attempt <= now)
+
+        query = table.select(
+            table.id, where=claimable, order_by=[table.id.asc],
+            limit=batch_size
+        )
+        if backend.name() == 'postgresql':
+            sql, params = tuple(query)
+            cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+        else:
+            cursor.execute(*query)
+        ids = [id for id, in cursor.fetchall()]
+        if not ids:
+            return []
+
+        cursor.execute(*table.update(
+            columns=[table.state, table.next_attempt],
+            values=['sending', claimed_until],
+            where=table.id.in_(ids) & claimable
+        ))
+
+        # The mails may already have been read
+        invalidate_cache(cls.__name__, ids)
+
+        cursor.execute(*table.select(
+            table.id,
+            where=table.id.in_(ids) & (table.state == 'sending') &
+            (table.next_attempt == claimed_until),
+            order_by=[table.id.asc]
+        ))
+        return cls.browse([id for id, in cursor.fetchall()])
+
+    @classmethod
+    def send_all(cls, batch_size=None, commit=False):
+        """
+        Drain the outbox in batches of `batch_size` mails. This is the
+        entry point of the cron.
+
+        If `commit` is set, as the cron does, the claim of each batch is
+        committed before the mails are sent and their result right after,
+        so that the mails handed to the SMTP server are not sent again when
+        a later batch fails or the worker is killed.
+        """
+        if batch_size is None:
+            batch_size = config.getint(
+                'nereid_crm', 'outbox_batch_size', default=100
+            )
+        cursor = Transaction().cursor
+
+        while True:
+            mails = cls.claim_batch(batch_size)
+            if not mails:
+                break
+            if commit:
+                cursor.commit()
+            cls.send_batch(mails)
+            if commit:
+                cursor.commit()
+
+    @classmethod
+    def purge(cls, batch_size=None, commit=False):
+        """
+        Delete, in batches of `batch_size` mails, the sent mails older than
+        `outbox_sent_retention_days` and the failed mails, kept for
+        inspection, older than `outbox_failed_retention_days`. This is the
+        entry point of the daily cron, which commits each batch.
+        """
+        if batch_size is None:
+            batch_size = config.getint(
+                'nereid_crm', 'outbox_batch_size', default=100
+            )
+        now = datetime.now()
+        sent_before = now - timedelta(days=config.getint(
+            'nereid_crm', 'outbox_sent_retention_days', default=7
+        ))
+        failed_before = now - timedelta(days=config.getint(
+            'nereid_crm', 'outbox_failed_retention_days', default=30
+        ))
+        cursor = Transaction().cursor
+
+        while True:
+            # The last write of a sent or failed mail is its last attempt
+            mails = cls.search(['OR', [
+                ('state', '=', 'sent'),
+                ('write_date', '<', sent_before),
+            ], [
+                ('state', '=', 'failed'),
+                ('write_date', '<', failed_before),
+            ]], order=[('id', 'ASC')], limit=batch_size)
+            if not mails:
+                break
+            cls.delete(mails)
+            if commit:
+                cursor.commit()
+
+    @classmethod
+    def send_batch(cls, mails):
+        """
+        Send the given mails over the pooled SMTP connections. Mails which
+        could not be sent are scheduled for a retry.
+        """
+        pool = get_pool()
+
+        sent = []
+        for mail in mails:
+            try:
+                pool.sendmail(
+                    mail.from_addr, mail.to_addrs.split(','), mail.msg
+                )
+            except Exception, exc:
+                logger.exception("Could not send mail %d", mail.id)
+                mail.record_failure(exc)
+            else:
+                sent.append(mail)
+
+        if sent:
+            cls.write(sent, {'state': 'sent', 'next_attempt': None})
+
+    def record_failure(self, exc):
+        """
+        Record a failed delivery and schedule the next attempt, or mark
+        the mail as failed once the attempts are exhausted.
+        """
+        max_attempts = config.getint(
+            'nereid_crm', 'outbox_max_attempts', default=5
+        )
+        self.attempts += 1
+        self.last_error = unicode(exc)
+        if self.attempts >= max_attempts:
+            self.state = 'failed'
+            self.next_attempt = None
+        else:
+            self.state = 'outbox'
+            self.next_attempt = datetime.utcnow() + \
+                self.get_retry_delay(self.attempts)
+        self.save()
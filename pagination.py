@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    pagination
+
+    Keyset pagination of records ordered by creation date
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import base64
+from datetime import datetime
+
+import simplejson as json
+from werkzeug.utils import cached_property
+
+
+__all__ = ['KeysetPagination']
+
+
+class KeysetPagination(object):
+    """
+    Paginate the records of a model from the newest to the oldest using
+    the (create_date, id) of the last record seen instead of an offset.
+
+    Fetching a page is a single indexed range query whatever its depth, and
+    the total count is only computed when `with_count` is set. The pages are
+    addressed with opaque cursors, given by :attr:`next_cursor` and
+    :attr:`prev_cursor`.
+
+    :param obj: The model to paginate
+    :param domain: Domain to filter the records
+    :param cursor: The cursor of the page to display, None for the first page
+    :param per_page: Items per page
+    :param with_count: Compute the total count of records
+    """
+
+    def __init__(self, obj, domain, cursor=None, per_page=10,
+                 with_count=False):
+        self.obj = obj
+        self.domain = domain
+        self.per_page = per_page
+        self.with_count = with_count
+        if cursor:
+            self.direction, self.key = self.decode_cursor(cursor)
+        else:
+            self.direction, self.key = None, None
+
+    @staticmethod
+    def encode_cursor(direction, record):
+        "Return the cursor to move in `direction` from the record"
+        return base64.urlsafe_b64encode(json.dumps([
+            direction, record.create_date.isoformat(), record.id
+        ]))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Return the direction and the (create_date, id) key of a cursor.
+        Raises ValueError if the cursor is not valid.
+        """
+        try:
+            direction, create_date, id = json.loads(
+                base64.urlsafe_b64decode(str(cursor))
+            )
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+        if direction not in ('next', 'prev') or \
+                not isinstance(id, (int, long)):
+            raise ValueError('Invalid cursor')
+        for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return direction, (datetime.strptime(create_date, format_), id)
+            except (TypeError, ValueError):
+                continue
+        raise ValueError('Invalid cursor')
+
+    @cached_property
+    def _page(self):
+        """
+        Return the records of the page and whether there are more records
+        in the direction of the cursor.
+        """
+        domain = list(self.domain)
+        if self.key is not None:
+            create_date, id = self.key
+            operator = '<' if self.direction == 'next' else '>'
+            domain.append([
+                'OR',
+                ('create_date', operator, create_date),
+                [
+                    ('create_date', '=', create_date),
+                    ('id', operator, id),
+                ],
+            ])
+        if self.direction == 'prev':
+            order = [('create_date', 'ASC'), ('id', 'ASC')]
+        else:
+            order = [('create_date', 'DESC'), ('id', 'DESC')]
+
+        records = self.obj.search(
+            domain, limit=self.per_page + 1, order=order
+        )
+        more = len(records) > self.per_page
+        records = records[:self.per_page]
+        if self.direction == 'prev':
+            records.reverse()
+        return records, more
+
+    def items(self):
+        "Returns the list of items in current page"
+        return self._page[0]
+
+    def __iter__(self):
+        for item in self.items():
+            yield item
+
+    def __len__(self):
+        return len(self.items())
+
+    @cached_property
+    def count(self):
+        "The total number of records, None unless `with_count` is set"
+        if not self.with_count:
+            return None
+        return self.obj.search(self.domain, count=True)
+
+    @property
+    def has_next(self):
+        if self.direction == 'prev':
+            return True
+        return self._page[1]
+
+    @property
+    def has_prev(self):
+        if self.direction == 'prev':
+            return self._page[1]
+        return self.direction == 'next'
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items():
+            return self.encode_cursor('next', self.items()[-1])
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items():
+            return self.encode_cursor('prev', self.items()[0])
+
+    def serialize(self):
+        return {
+            "count": self.count,
+            "per_page": self.per_page,
+            "next_cursor": self.next_cursor,
+            "prev_cursor": self.prev_cursor,
+            "items": self.items(),
+        }
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    party
+
+    Normalized email index of the contact mechanisms, and synchronisation
+    of the search columns of the leads with the parties
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+
+from sql.aggregate import Count
+from sql.conditionals import Case
+from sql.functions import Lower, Trim
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.config import config
+from trytond import backend
+
+from tools import invalidate_cache
+
+
+__all__ = ['Party', 'Address', 'ContactMechanism', 'normalize_email']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger('nereid_crm.party')
+
+
+def normalize_email(email):
+    """
+    Return the key under which an email address is indexed
+    """
+    return email.strip(' ').lower() if email else None
+
+
+def update_lead_search_columns(ids, field):
+    """
+    Update the search columns of the leads whose `field` is in `ids`
+    """
+    Opportunity = Pool().get('sale.opportunity')
+    Opportunity._update_search_columns(ids, field)
+
+
+class Party:
+    "Party"
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+
+        actions = iter(args)
+        to_update = []
+        for parties, values in zip(actions, actions):
+            if 'name' in values:
+                to_update.extend(parties)
+        if to_update:
+            update_lead_search_columns(to_update, 'party')
+
+
+class Address:
+    "Address"
+    __name__ = 'party.address'
+
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+
+        actions = iter(args)
+        to_update = []
+        for addresses, values in zip(actions, actions):
+            if 'name' in values:
+                to_update.extend(addresses)
+        if to_update:
+            update_lead_search_columns(to_update, 'address')
+
+
+class ContactMechanism:
+    "Contact Mechanism"
+    __name__ = 'party.contact_mechanism'
+
+    #: The lower cased email address, used to find the party of an email
+    #: with an indexed lookup. It is maintained in SQL on every write.
+    email_normalized = fields.Char(
+        'Normalized E-Mail', readonly=True, select=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        table = TableHandler(cursor, cls, module_name)
+        backfill = not table.column_exist('email_normalized')
+
+        super(ContactMechanism, cls).__register__(module_name)
+
+        if backfill:
+            cls._fill_email_normalized()
+
+    @classmethod
+    def _fill_email_normalized(cls):
+        """
+        Fill the normalized email added by the update to an existing table.
+
+        Only a table of at most one batch of email addresses is filled in
+        the transaction of the update, a larger one is left to the
+        `Backfill Normalized E-Mails` cron which runs once after the update
+        and commits each batch.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        batch_size = config.getint(
+            'nereid_crm', 'search_backfill_batch_size', default=1000
+        )
+
+        cursor.execute(*table.select(
+            Count(table.id), where=table.type == 'email'
+        ))
+        count, = cursor.fetchone()
+        if count <= batch_size:
+            cls.backfill_email_normalized(batch_size)
+            return
+        logger.warning(
+            "The normalized emails of the %d email addresses are empty, the "
+            "leads will not be attached to their parties until the "
+            "'Backfill Normalized E-Mails' cron has run", count
+        )
+
+    @classmethod
+    def backfill_email_normalized(cls, batch_size=None, commit=False):
+        """
+        Fill the normalized email of the existing email addresses in
+        batches of `batch_size`, committing each batch if `commit` is set.
+        This is the entry point of the cron, which runs once after the
+        module is installed or updated.
+        """
+        if batch_size is None:
+            batch_size = config.getint(
+                'nereid_crm', 'search_backfill_batch_size', default=1000
+            )
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(
+                table.id,
+                where=(table.id > last_id) & (table.type == 'email'),
+                order_by=[table.id.asc], limit=batch_size
+            ))
+            ids = [id for id, in cursor.fetchall()]
+            if not ids:
+                break
+            cls._update_email_normalized(ids)
+            if commit:
+                cursor.commit()
+            last_id = ids[-1]
+
+    @classmethod
+    def _update_email_normalized(cls, mechanisms):
+        """
+        Compute the normalized email of the given contact mechanisms with a
+        single UPDATE.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = map(int, mechanisms)
+        cursor.execute(*table.update(
+            columns=[table.email_normalized],
+            values=[Case(
+                (table.type == 'email', Lower(Trim(table.value))),
+                else_=None
+            )],
+            where=table.id.in_(ids)
+        ))
+
+        # The records may already have been read, by the validation of the
+        # create or write for example
+        invalidate_cache(cls.__name__, ids)
+
+    @classmethod
+    def create(cls, vlist):
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        cls._update_email_normalized(mechanisms)
+        update_lead_search_columns(
+            set(m.party.id for m in mechanisms if m.type == 'email'), 'party'
+        )
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        super(ContactMechanism, cls).write(*args)
+
+        actions = iter(args)
+        to_update, parties = [], set()
+        for mechanisms, values in zip(actions, actions):
+            changed = set(values)
+            if changed & set(['type', 'value', 'email']):
+                to_update.extend(mechanisms)
+            if changed & set(['type', 'value', 'email', 'active', 'sequence']):
+                parties.update(m.party.id for m in mechanisms)
+        if to_update:
+            cls._update_email_normalized(to_update)
+        if parties:
+            update_lead_search_columns(parties, 'party')
+
+    @classmethod
+    def delete(cls, mechanisms):
+        parties = set(m.party.id for m in mechanisms if m.type == 'email')
+        super(ContactMechanism, cls).delete(mechanisms)
+        if parties:
+            update_lead_search_columns(parties, 'party')
+
+    @classmethod
+    def get_parties_by_email(cls, emails):
+        """
+        Return a dictionary of the normalized emails to the oldest party
+        having this email, for those of the given emails which are known.
+        """
+        keys = filter(None, set(map(normalize_email, emails)))
+        if not keys:
+            return {}
+
+        parties = {}
+        mechanisms = cls.search([
+            ('email_normalized', 'in', keys),
+        ], order=[('id', 'DESC')])
+        for mechanism in mechanisms:
+            parties[mechanism.email_normalized] = mechanism.party
+        return parties
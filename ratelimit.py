@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit
+
+    Token bucket rate limiter of the public forms
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from trytond.cache import LRUDict
+from trytond.config import config
+
+
+__all__ = ['MemoryStore', 'SQLiteStore', 'RateLimiter', 'lead_rate_limiter']
+
+
+class MemoryStore(object):
+    """
+    Keep the buckets in the memory of the process, so every worker has its
+    own. Only the `max_keys` most recently used buckets are kept.
+    """
+
+    def __init__(self, max_keys=10000):
+        self._buckets = LRUDict(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, keys, rate, burst, now):
+        """
+        Take a token from the bucket of each key if all of them have one.
+        Returns True if the tokens were taken.
+
+        :param rate: Tokens added to a bucket per second
+        :param burst: Capacity of a bucket
+        :param now: Current time in seconds
+        """
+        with self._lock:
+            buckets = []
+            for key in keys:
+                tokens, updated = self._buckets.pop(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                buckets.append((key, tokens))
+            allowed = all(tokens >= 1 for key, tokens in buckets)
+            for key, tokens in buckets:
+                if allowed:
+                    tokens -= 1
+                self._buckets[key] = (tokens, now)
+            return allowed
+
+
+class SQLiteStore(object):
+    """
+    Keep the buckets in a SQLite database, so that all the workers of the
+    host share them. The buckets which are full again are purged every
+    `purge_interval` calls.
+    """
+
+    def __init__(self, path, purge_interval=1000):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._calls = 0
+        self._pid = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        "Return the connection of the process"
+        if self._pid != os.getpid():
+            # Do not share the connection of the parent of a forked worker
+            self._connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None,
+                check_same_thread=False
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket ('
+                'key TEXT PRIMARY KEY, tokens REAL, updated REAL)'
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def take(self, keys, rate, burst, now):
+        "See :meth:`MemoryStore.take`"
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                buckets = []
+                for key in keys:
+                    row = connection.execute(
+                        'SELECT tokens, updated FROM bucket WHERE key = ?',
+                        (key,)
+                    ).fetchone()
+                    tokens, updated = row or (burst, now)
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                    buckets.append((key, tokens))
+                allowed = all(tokens >= 1 for key, tokens in buckets)
+                connection.executemany(
+                    'INSERT OR REPLACE INTO bucket (key, tokens, updated) '
+                    'VALUES (?, ?, ?)', [
+                        (key, left - 1 if allowed else left, now)
+                        for key, left in buckets
+                    ]
+                )
+
+                self._calls += 1
+                if self._calls % self.purge_interval == 0:
+                    connection.execute(
+                        'DELETE FROM bucket WHERE updated < ?',
+                        (now - burst / rate,)
+                    )
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return allowed
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter.
+
+    Every key has a bucket of `burst` tokens which is refilled at `rate`
+    tokens per minute, and a request is allowed if the buckets of all its
+    keys have a token left. The check does not touch the database of
+    Tryton, so that abusive requests are rejected before any real work.
+
+    The options are read from the `nereid_crm` section of the trytond
+    configuration unless given explicitly:
+
+    * `ratelimit_rate`: Requests per minute and key, 0 (the default)
+      disables the limiter
+    * `ratelimit_burst`: Requests allowed at once (default 10)
+    * `ratelimit_store`: `memory` (default) for buckets per worker or
+      `sqlite` for buckets shared by the workers of the host
+    * `ratelimit_path`: Path of the SQLite database of the buckets
+    """
+    default_path = '/tmp/nereid_crm_ratelimit.sqlite'
+
+    def __init__(self, rate=None, burst=None, store=None):
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+
+    def _configure(self):
+        if self.rate is None:
+            self.rate = config.getfloat(
+                'nereid_crm', 'ratelimit_rate', default=0
+            )
+        if self.burst is None:
+            self.burst = config.getint(
+                'nereid_crm', 'ratelimit_burst', default=10
+            )
+        if self.store is None:
+            if config.get('nereid_crm', 'ratelimit_store') == 'sqlite':
+                self.store = SQLiteStore(config.get(
+                    'nereid_crm', 'ratelimit_path', default=self.default_path
+                ))
+            else:
+                self.store = MemoryStore()
+
+    def allow(self, *keys):
+        """
+        Return True if a request with the given keys is allowed. Empty
+        keys are ignored.
+        """
+        if self.store is None:
+            self._configure()
+        keys = filter(None, keys)
+        if not self.rate or not keys:
+            return True
+        return self.store.take(
+            keys, self.rate / 60.0, self.burst, time.time()
+        )
+
+
+#: The limiter of the public lead form
+lead_rate_limiter = RateLimiter()
@@ -24,10 +24,13 @@ class SQLiteTest(Command):
     """
     description = "Run tests on SQLite"
 
-    user_options = []
+    user_options = [
+        ('benchmark', None, "Run the benchmark instead of the tests"),
+    ]
+    boolean_options = ['benchmark']
 
     def initialize_options(self):
-        pass
+        self.benchmark = False
 
     def finalize_options(self):
         pass
@@ -40,7 +43,10 @@ class SQLiteTest(Command):
         os.environ['TRYTOND_DATABASE_URI'] = 'sqlite://'
         os.environ['DB_NAME'] = ':memory:'
 
-        from tests import suite
+        if self.benchmark:
+            from tests.benchmark import suite
+        else:
+            from tests import suite
         test_result = unittest.TextTestRunner(verbosity=3).run(suite())
 
         if test_result.wasSuccessful():
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    smtp_pool
+
+    A bounded pool of long lived SMTP connections
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import time
+import socket
+import smtplib
+import logging
+import threading
+
+from trytond.config import config
+from trytond.tools import get_smtp_server
+
+
+__all__ = ['SMTPConnectionPool', 'PoolTimeout', 'get_pool']
+
+logger = logging.getLogger('nereid_crm.smtp_pool')
+
+#: Errors after which a connection can no longer be used
+CONNECTION_ERRORS = (
+    smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error,
+)
+
+
+class PoolTimeout(Exception):
+    "No connection became available in time"
+
+
+class SMTPConnectionPool(object):
+    """
+    A thread safe pool of SMTP connections.
+
+    At most `max_size` connections are open at any time. Idle connections
+    are kept open for `idle_timeout` seconds. Those idle for more than
+    `check_after` seconds are checked with a `NOOP` before being handed
+    out again, so that connections dropped by the server are replaced
+    without a round trip before each mail of a burst. A connection lost
+    in between is replaced by :meth:`sendmail`.
+
+    :param factory: A callable returning a new connected SMTP instance
+    :param max_size: Maximum number of open connections
+    :param idle_timeout: Seconds after which an idle connection is closed
+    :param wait_timeout: Seconds to wait for a free connection
+    :param check_after: Seconds of idleness after which a connection is
+                        checked before being reused
+    """
+
+    def __init__(
+        self, factory=get_smtp_server, max_size=4, idle_timeout=60,
+        wait_timeout=30, check_after=5
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.check_after = check_after
+        self._idle = []
+        self._size = 0
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+
+    @property
+    def size(self):
+        "Number of open connections, idle or in use"
+        return self._size
+
+    def _check_pid(self):
+        """
+        Forget the connections inherited from a parent process. The sockets
+        belong to the parent and must not be used by the forked worker.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._size = 0
+
+    @staticmethod
+    def is_healthy(connection):
+        "Check that the server is still answering on the connection"
+        try:
+            return connection.noop()[0] == 250
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.quit()
+        except Exception:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """
+        Return a healthy connection from the pool, opening a new one if
+        none is idle and the pool is not full.
+        """
+        deadline = time.time() + self.wait_timeout
+        while True:
+            with self._condition:
+                self._check_pid()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "No SMTP connection available after %ss" %
+                            self.wait_timeout
+                        )
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                else:
+                    connection, last_used = None, None
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    return self.factory()
+                except Exception:
+                    self._forget()
+                    raise
+
+            idle = time.time() - last_used
+            if idle < self.idle_timeout and (
+                    idle < self.check_after or self.is_healthy(connection)):
+                return connection
+
+            # Stale connection, close it and try again
+            self.discard(connection)
+
+    def release(self, connection):
+        "Return a connection to the pool"
+        with self._condition:
+            self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+    def discard(self, connection):
+        "Close a connection which should not be reused"
+        self._close(connection)
+        self._forget()
+
+    def _forget(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send a mail over a pooled connection. If the connection turns out
+        to be broken, the mail is sent once more over a new connection.
+        """
+        for retry in (True, False):
+            connection = self.acquire()
+            try:
+                result = connection.sendmail(from_addr, to_addrs, msg)
+            except CONNECTION_ERRORS:
+                self.discard(connection)
+                if retry:
+                    logger.warning("SMTP connection lost, reconnecting")
+                    continue
+                raise
+            except (
+                smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused
+            ):
+                # The server refused this mail, the connection is fine
+                self.release(connection)
+                raise
+            except Exception:
+                self.discard(connection)
+                raise
+            else:
+                self.release(connection)
+                return result
+
+    def close_idle(self):
+        "Close the connections which have been idle for too long"
+        with self._condition:
+            self._check_pid()
+            now = time.time()
+            stale = [
+                c for c, last_used in self._idle
+                if now - last_used >= self.idle_timeout
+            ]
+            self._idle = [
+                (c, last_used) for c, last_used in self._idle
+                if now - last_used < self.idle_timeout
+            ]
+        for connection in stale:
+            self.discard(connection)
+
+    def close_all(self):
+        "Close all the idle connections"
+        with self._condition:
+            self._check_pid()
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            self.discard(connection)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the pool of the process, configured from the `nereid_crm`
+    section of the trytond configuration.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPConnectionPool(
+                max_size=config.getint(
+                    'nereid_crm', 'smtp_pool_size', default=4
+                ),
+                idle_timeout=config.getint(
+                    'nereid_crm', 'smtp_idle_timeout', default=60
+                ),
+                check_after=config.getint(
+                    'nereid_crm', 'smtp_check_after', default=5
+                ),
+            )
+        return _pool
@@ -11,6 +11,7 @@ import unittest
 
 import trytond.tests.test_tryton
 from test_opportunity import NereidCRMTestCase
+from test_smtp_pool import SMTPPoolTestCase
 
 
 def suite():
@@ -18,6 +19,9 @@ def suite():
     test_suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(NereidCRMTestCase)
     )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(SMTPPoolTestCase)
+    )
     return test_suite
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Performance benchmark of the CRM handlers on synthetic datasets.
+
+    Run it with `python setup.py test --benchmark`. The sizes of the
+    datasets are given by the BENCHMARK_SIZES environment variable (comma
+    separated, 10000,100000,1000000 by default) and the results are written
+    as JSON to the file given by BENCHMARK_OUTPUT (benchmark.json by
+    default).
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import platform
+import unittest
+from datetime import datetime
+
+import simplejson as json
+
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond import backend
+
+from test_opportunity import NereidCRMTestCase
+
+
+class NereidCRMBenchmark(NereidCRMTestCase):
+    '''
+    Benchmark the CRM handlers through the Nereid test client.
+
+    It reuses the fixtures of the tests, only its `bench_` methods are
+    run.
+    '''
+    #: Number of leads created by capture_leads at once
+    chunk_size = 1000
+
+    #: Number of times each handler is called
+    repeat = 10
+
+    def setUp(self):
+        super(NereidCRMBenchmark, self).setUp()
+        self.sizes = map(int, os.environ.get(
+            'BENCHMARK_SIZES', '10000,100000,1000000'
+        ).split(','))
+        self.output = os.environ.get('BENCHMARK_OUTPUT', 'benchmark.json')
+        self.templates['crm/admin-lead.jinja'] = '{{ lead.rec_name }}'
+
+    def create_dataset(self, size):
+        """
+        Create `size` leads, with their party, address and email, phone and
+        website contact mechanisms, and a review for every tenth lead when
+        reviews are available. A tenth of the leads are opportunities.
+        """
+        employees = [
+            self.crm_admin.employee.id, self.crm_admin2.employee.id
+        ]
+        for start in xrange(0, size, self.chunk_size):
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Contact %d' % i,
+                'company': 'Company %d' % i,
+                'email': 'contact%d@example.com' % i,
+                'phone': '+1 555 %07d' % i,
+                'website': 'www.company%d.com' % i,
+                'comment': 'Comment of the lead %d' % i,
+                'ip_address': '10.0.%d.%d' % (i // 256 % 256, i % 256),
+            } for i in xrange(start, min(start + self.chunk_size, size))],
+                self.company.id,
+                employees[start // self.chunk_size % len(employees)],
+                'Benchmark')
+            self.sale_opp_obj.opportunity(leads[::10])
+            self.create_reviews(leads[::10])
+
+    def create_reviews(self, leads):
+        "Create a review of each lead if the reviews are available"
+        if 'nereid.review' not in POOL.object_name_list():
+            return
+        Review = POOL.get('nereid.review')
+        Review.create([{
+            'lead': lead.id,
+            'title': 'Call',
+            'comment': 'Called the lead',
+            'nereid_user': self.crm_admin.id,
+            'party': lead.party.id,
+        } for lead in leads])
+
+    def measure(self, function, repeat=None):
+        """
+        Return the timings in seconds of `repeat` calls of the function.
+        The function is given the number of the call.
+        """
+        timings = []
+        for i in xrange(repeat or self.repeat):
+            start = time.time()
+            function(i)
+            timings.append(time.time() - start)
+        timings.sort()
+        return {
+            'repeat': len(timings),
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+            'max': timings[-1],
+        }
+
+    def get(self, client, url):
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+
+    def post(self, client, url, data=None):
+        response = client.post(url, data=data, headers=self.xhr_header)
+        self.assertTrue(response.status_code in (200, 302), url)
+
+    def time_handlers(self, client, size):
+        "Return the timings of the handlers, by name"
+        lead, = self.sale_opp_obj.search(
+            [], order=[('id', 'ASC')], offset=size // 2, limit=1
+        )
+        results = {}
+
+        results['new_opportunity'] = self.measure(
+            lambda i: self.post(client, '/sales/opportunity/-new', {
+                'name': 'New %d' % i,
+                'company': 'New Company %d' % i,
+                'email': 'new%d@example.com' % i,
+                'comment': 'From the benchmark',
+            })
+        )
+
+        for name, query in (
+                ('all_leads', ''),
+                ('all_leads_company', '?company=Company 1234'),
+                ('all_leads_name', '?name=Contact 1234'),
+                ('all_leads_email', '?email=contact1234@'),
+                ('all_leads_state', '?state=opportunity'),
+                ('all_leads_deep_page', '/%d' % max(size // 20, 1)),
+                ('all_leads_cursor', '?cursor='),
+                ):
+            url = '/sales/opportunity/leads' + query
+            results[name] = self.measure(
+                lambda i: self.get(client, url)
+            )
+
+        results['sales_home'] = self.measure(
+            lambda i: self.get(client, '/sales')
+        )
+        results['admin_lead'] = self.measure(
+            lambda i: self.get(
+                client, '/sales/opportunity/lead/%d' % lead.id
+            )
+        )
+
+        # Each transition is followed by the one moving the lead back
+        for name, transition, back in (
+                ('mark_opportunity', 'opportunity', 'lead'),
+                ('mark_lost', 'lost', 'lead'),
+                ('mark_cancelled', 'cancel', 'lead'),
+                ):
+            def cycle(i):
+                self.post(client, '/lead-%d/-%s' % (lead.id, transition))
+                self.post(client, '/lead-%d/-%s' % (lead.id, back))
+            results[name] = self.measure(cycle)
+        return results
+
+    def bench_0010_handlers(self):
+        """
+        Time the handlers on datasets of each size
+        """
+        report = {
+            'date': datetime.utcnow().isoformat(),
+            'backend': backend.name(),
+            'python': platform.python_version(),
+            'repeat': self.repeat,
+            'results': {},
+        }
+        for size in self.sizes:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.setup_defaults()
+
+                start = time.time()
+                self.create_dataset(size)
+                result = {'create_dataset': time.time() - start}
+
+                app = self.get_app()
+                with app.test_client() as client:
+                    self.post(client, '/login', {
+                        'email': 'admin@openlabs.co.in',
+                        'password': 'password',
+                    })
+                    result.update(self.time_handlers(client, size))
+                report['results'][size] = result
+
+        with open(self.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        sys.stderr.write('Benchmark written to %s\n' % self.output)
+
+
+class BenchmarkLoader(unittest.TestLoader):
+    testMethodPrefix = 'bench'
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(BenchmarkLoader().loadTestsFromTestCase(
+        NereidCRMBenchmark))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
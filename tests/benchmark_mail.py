@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_mail
+
+    Compare the cost of rendering the notification mails with
+    render_email and with the mail renderer of the CRM.
+
+    Usage: python tests/benchmark_mail.py [number of messages]
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import time
+from collections import namedtuple
+
+from flask import Flask
+from jinja2 import DictLoader
+from nereid import render_email
+
+from trytond.modules.nereid_crm.mailer import MailRenderer
+
+TEMPLATE_NAME = 'crm/emails/lead_thank_you_mail.jinja'
+TEMPLATE = u"""Dear {{ lead.party.name }},
+
+Thank you for your query, one of our sales representatives will get in
+touch with you shortly.
+
+{{ lead.comment }}
+"""
+
+Party = namedtuple('Party', ['name', 'email'])
+Lead = namedtuple('Lead', ['party', 'comment'])
+
+
+def get_app():
+    app = Flask(__name__)
+    app.jinja_loader = DictLoader({TEMPLATE_NAME: TEMPLATE})
+    # The options of nereid used by render_email
+    app.template_prefix_website_name = False
+    app.eager_template_render = False
+    return app
+
+
+def bench(name, render, leads):
+    start = time.time()
+    for lead in leads:
+        render(lead)
+    elapsed = time.time() - start
+    print '%-14s %8d messages %8.2f s %8.1f us/message' % (
+        name, len(leads), elapsed, elapsed / len(leads) * 10 ** 6
+    )
+
+
+def main(count):
+    leads = [
+        Lead(Party(u'Lead %d' % i, u'lead%d@example.com' % i), u'Comment')
+        for i in xrange(count)
+    ]
+    renderer = MailRenderer(TEMPLATE_NAME)
+
+    def nereid_render(lead):
+        return render_email(
+            'sales@example.com', lead.party.email,
+            'Thank You for your query', text_template=TEMPLATE_NAME,
+            lead=lead
+        ).as_string()
+
+    def crm_render(lead):
+        return renderer.render(
+            'sales@example.com', [lead.party.email],
+            'Thank You for your query', lead=lead
+        )
+
+    with get_app().test_request_context('/'):
+        bench('render_email', nereid_render, leads)
+        bench('MailRenderer', crm_render, leads)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
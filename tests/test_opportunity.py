@@ -10,18 +10,41 @@
 import sys
 import os
 import unittest
+import csv
+import tempfile
+from contextlib import contextmanager
+from decimal import Decimal
+from StringIO import StringIO
+from email import message_from_string
 import datetime
 import simplejson as json
 from dateutil.relativedelta import relativedelta
 
 from mock import patch
+from wtforms import Form
+from werkzeug.datastructures import MultiDict
 from trytond.config import config
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond import backend
 from trytond.tests.test_tryton import test_view, test_depends
+from flask.signals import request_finished
+from nereid import render_email, LazyRenderer
 from nereid.testing import NereidTestCase
+from trytond.modules.nereid_crm.opportunity import Many2OneField, \
+    NereidReview
+from trytond.modules.nereid_crm.geoip_lookup import GeoIPLookup
+from trytond.modules.nereid_crm.mailer import MailRenderer
+from trytond.modules.nereid_crm.metrics import registry, Histogram, \
+    query_budget, QueryBudgetExceeded, instrument
+from trytond.modules.nereid_crm.ratelimit import RateLimiter, MemoryStore, \
+    SQLiteStore
+from trytond.modules.nereid_crm.tools import invalidate_cache
 
 DIR = os.path.abspath(
     os.path.normpath(
@@ -36,6 +59,23 @@ if os.path.isdir(DIR):
 config.set('email', 'from', 'test@openlabs.co.in')
 
 
+class Review(NereidReview, ModelSQL):
+    """
+    The reviews of nereid, which are missing from some releases of nereid
+    """
+    __name__ = 'nereid.review'
+
+    title = fields.Char('Title')
+    comment = fields.Text('Comment')
+    nereid_user = fields.Many2One('nereid.user', 'Nereid User')
+    party = fields.Many2One('party.party', 'Party')
+
+if not any(
+        cls.__name__ == 'nereid.review'
+        for cls in Pool.classes['model'].get('nereid', [])):
+    Pool.register(Review, module='nereid_crm', type_='model')
+
+
 class NereidCRMTestCase(NereidTestCase):
     '''
     Test Nereid CRM module.
@@ -57,6 +97,7 @@ class NereidCRMTestCase(NereidTestCase):
         self.Config = POOL.get('sale.configuration')
         self.Party = POOL.get('party.party')
         self.Locale = POOL.get('nereid.website.locale')
+        self.Outbox = POOL.get('nereid.crm.outbox')
         self.xhr_header = [
             ('X-Requested-With', 'XMLHttpRequest'),
         ]
@@ -72,6 +113,8 @@ class NereidCRMTestCase(NereidTestCase):
             '{{ login_form.errors }} {{get_flashed_messages()}}',
             'crm/sale_form.jinja': ' ',
             'crm/leads.jinja': '{{leads|length}}',
+            'crm/home.jinja':
+            '{{ counter.lead }}-{{ counter.opportunity }}',
             'crm/emails/lead_thank_you_mail.jinja': ' ',
             'crm/emails/sale_notification_text.jinja': ' ',
         }
@@ -352,6 +395,126 @@ class NereidCRMTestCase(NereidTestCase):
                 self.assertEqual(response.status_code, 200)
                 self.assertTrue(json.loads(response.data)['success'])
 
+    def test_0015_notification_mails_outbox(self):
+        """
+        Test that the notification mails are queued in the outbox and sent
+        by the outbox cron
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.post(
+                    '/sales/opportunity/-new',
+                    data={
+                        'company': 'ABC',
+                        'name': 'Tarun',
+                        'email': 'demo@example.com',
+                        'comment': 'comment',
+                    },
+                    headers=self.xhr_header,
+                )
+                self.assertEqual(response.status_code, 200)
+
+            # Nothing is sent in the request, both mails are queued
+            self.assertFalse(self.mocked_smtp_instance.sendmail.called)
+            mails = self.Outbox.search([('state', '=', 'outbox')])
+            self.assertEqual(len(mails), 2)
+
+            # A failed delivery is retried later
+            self.mocked_smtp_instance.sendmail.side_effect = Exception()
+            self.Outbox.send_all()
+            for mail in mails:
+                self.assertEqual(mail.state, 'outbox')
+                self.assertEqual(mail.attempts, 1)
+                self.assertTrue(mail.next_attempt > datetime.datetime.utcnow())
+
+            self.mocked_smtp_instance.sendmail.side_effect = None
+            self.Outbox.write(mails, {
+                'next_attempt': datetime.datetime.utcnow(),
+            })
+            self.Outbox.send_all()
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'sent')], count=True), 2
+            )
+
+            # A claimed mail is not sent by another cron until its claim
+            # expires
+            mail, = self.Outbox.queue_mail(
+                'sales@example.com', ['lead@example.com'], 'Message'
+            )
+            self.assertEqual(self.Outbox.claim_batch(10), [mail])
+            self.assertEqual(mail.state, 'sending')
+            self.assertEqual(self.Outbox.claim_batch(10), [])
+            self.Outbox.write([mail], {
+                'next_attempt': datetime.datetime.utcnow(),
+            })
+            self.assertEqual(self.Outbox.claim_batch(10), [mail])
+
+            # The cron commits the claim and the result of each batch
+            self.Outbox.write([mail], {
+                'next_attempt': datetime.datetime.utcnow(),
+            })
+            self.Outbox.queue_mail(
+                'sales@example.com', ['lead@example.com'], 'Message'
+            )
+            sendmail = self.mocked_smtp_instance.sendmail
+            sendmail.reset_mock()
+            with patch.object(Transaction().cursor, 'commit') as commit:
+                self.Outbox.send_all(batch_size=1, commit=True)
+            self.assertEqual(commit.call_count, 4)
+            self.assertEqual(sendmail.call_count, 2)
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'sent')], count=True), 4
+            )
+
+            # The mails of many leads are queued with a single create
+            with app.test_request_context('/'), patch.object(
+                    self.Outbox, 'create', wraps=self.Outbox.create) as create:
+                self.sale_opp_obj.capture_leads([{
+                    'name': 'Lead %d' % i,
+                    'email': 'lead%d@example.com' % i,
+                } for i in range(3)], self.company.id,
+                    self.crm_admin.employee.id, 'Notify', notify=True)
+            self.assertEqual(create.call_count, 1)
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'outbox')], count=True), 6
+            )
+
+            # The old sent and failed mails are purged
+            failed, = self.Outbox.queue_mail(
+                'sales@example.com', ['lead@example.com'], 'Message'
+            )
+            self.Outbox.write([failed], {'state': 'failed'})
+            table = self.Outbox.__table__()
+            cursor = Transaction().cursor
+            sent = self.Outbox.search([('state', '=', 'sent')])
+            cursor.execute(*table.update(
+                columns=[table.write_date],
+                values=[datetime.datetime.now() - datetime.timedelta(days=8)],
+                where=table.id.in_(map(int, sent[:3] + [failed]))
+            ))
+            self.Outbox.purge(batch_size=2)
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'sent')], count=True), 1
+            )
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'failed')], count=True), 1
+            )
+            cursor.execute(*table.update(
+                columns=[table.write_date],
+                values=[datetime.datetime.now() - datetime.timedelta(days=31)],
+                where=table.id == failed.id
+            ))
+            self.Outbox.purge()
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'failed')], count=True), 0
+            )
+            self.assertEqual(
+                self.Outbox.search([('state', '=', 'outbox')], count=True), 6
+            )
+
     def test_0020_revenue_opportunity(self):
         '''
         Test revenue_opportunity web handler
@@ -626,6 +789,1381 @@ class NereidCRMTestCase(NereidTestCase):
                 self.assertEqual(response.status_code, 302)
                 self.assertEqual(self.lead.state, 'lead')
 
+    def test_0060_sales_home_counter(self):
+        """
+        Test the state counters on the sales home page
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.post(
+                    '/login',
+                    data={
+                        'email': 'admin@openlabs.co.in',
+                        'password': 'password',
+                    }
+                )
+                self.assertEqual(response.status_code, 302)
+                response = c.get('/sales')
+                self.assertEqual(response.data, '1-0')
+
+                # The cached counters follow the state transitions
+                c.post('/lead-%d/-opportunity' % self.lead)
+                response = c.get('/sales')
+                self.assertEqual(response.data, '0-1')
+
+    def test_0070_country_choices_cache(self):
+        """
+        Test the cached country list used by the CRM pages and forms
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.Country.get_crm_choices(),
+                [(self.country.id, 'India')]
+            )
+
+            # Changing the countries invalidates the cache
+            nepal, = self.Country.create([{
+                'name': 'Nepal',
+                'code': 'NP',
+            }])
+            self.assertEqual(
+                self.Country.get_crm_choices(),
+                [(self.country.id, 'India'), (nepal.id, 'Nepal')]
+            )
+            self.Country.write([nepal], {'code': 'XN'})
+            self.assertIsNone(self.Country._crm_choices_cache.get('en_US'))
+
+            app = self.get_app()
+            with app.test_client() as c:
+                response = c.post(
+                    '/sales/opportunity/-new',
+                    data={
+                        'name': 'Tarun',
+                        'email': 'demo@example.com',
+                        'comment': 'comment',
+                        'country': nepal.id + 1,
+                    },
+                    headers=self.xhr_header,
+                )
+                result = json.loads(response.data)
+                self.assertFalse(result['success'])
+                self.assertTrue('country' in result['errors'])
+
+                response = c.post(
+                    '/sales/opportunity/-new',
+                    data={
+                        'name': 'Tarun',
+                        'email': 'demo@example.com',
+                        'comment': 'comment',
+                        'country': self.country.id,
+                    },
+                    headers=self.xhr_header,
+                )
+                self.assertTrue(json.loads(response.data)['success'])
+
+    def test_0080_many2one_field_choices(self):
+        """
+        Test the cached choices and validation of Many2OneField
+        """
+        class PartyForm(Form):
+            party = Many2OneField(
+                'Party', model='party.party', domain=[('name', 'like', 'C%')]
+            )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            party, = self.Party.search([('name', '=', 'Crm Admin')])
+
+            form = PartyForm(MultiDict([('party', str(party.id))]))
+            self.assertTrue(form.validate())
+            self.assertEqual(len(list(form.party.iter_choices())), 2)
+
+            company = self.company.party
+            form = PartyForm(MultiDict([('party', str(company.id))]))
+            self.assertFalse(form.validate())
+
+            # The choices are served from the cache until it is cleared
+            new_party, = self.Party.create([{'name': 'Customer'}])
+            form = PartyForm(MultiDict([('party', str(new_party.id))]))
+            self.assertFalse(form.validate())
+
+            Many2OneField.clear_cache()
+            form = PartyForm(MultiDict([('party', str(new_party.id))]))
+            self.assertTrue(form.validate())
+
+    def test_0090_geoip_lookup(self):
+        """
+        Test that the GeoIP database is opened lazily and the lookups are
+        cached
+        """
+        with patch('pygeoip.GeoIP') as PatchedGeoIP:
+            database = PatchedGeoIP.return_value
+            database.country_name_by_addr.side_effect = \
+                lambda addr: 'India' if addr.startswith('1.') else 'Nepal'
+
+            lookup = GeoIPLookup(__file__, cache_size=2)
+            self.assertFalse(PatchedGeoIP.called)
+
+            self.assertEqual(lookup.country_name_by_addr('1.1.1.1'), 'India')
+            self.assertEqual(lookup.country_name_by_addr('1.1.1.1'), 'India')
+            self.assertEqual(PatchedGeoIP.call_count, 1)
+            self.assertEqual(database.country_name_by_addr.call_count, 1)
+
+            # Least recently used addresses are evicted
+            lookup.country_name_by_addr('2.2.2.2')
+            lookup.country_name_by_addr('1.1.1.1')
+            lookup.country_name_by_addr('3.3.3.3')
+            self.assertEqual(database.country_name_by_addr.call_count, 3)
+            lookup.country_name_by_addr('2.2.2.2')
+            self.assertEqual(database.country_name_by_addr.call_count, 4)
+
+        missing = GeoIPLookup('/does/not/exist/GeoIP.dat')
+        self.assertIsNone(missing.country_name_by_addr('1.1.1.1'))
+
+    def test_0100_all_leads_filters(self):
+        """
+        Test the filters of the leads list
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.post(
+                    '/login',
+                    data={
+                        'email': 'admin@openlabs.co.in',
+                        'password': 'password',
+                    }
+                )
+                self.assertEqual(response.status_code, 302)
+                for filters, count in [
+                    ('company=ab', u'1'),
+                    ('company=xyz', u'0'),
+                    ('name=bc', u'1'),
+                    ('email=client@', u'1'),
+                    ('email=nobody@', u'0'),
+                    ('state=lead', u'1'),
+                    ('state=lost', u'0'),
+                ]:
+                    response = c.get('/sales/opportunity/leads?' + filters)
+                    self.assertEqual(response.data, count)
+
+    def test_0110_all_leads_keyset_pagination(self):
+        """
+        Test the keyset pagination of the leads list
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.sale_opp_obj.create([{
+                'party': self.lead.party.id,
+                'company': self.company,
+                'employee': self.crm_admin.employee.id,
+                'address': self.lead.address.id,
+                'description': 'Lead %d' % i,
+            } for i in range(24)])
+            app = self.get_app()
+
+            self.templates['crm/leads.jinja'] = \
+                '{{ leads|length }}|{{ leads.count }}|' \
+                '{{ leads.next_cursor or "" }}|{{ leads.prev_cursor or "" }}'
+
+            with app.test_client() as c:
+                response = c.post(
+                    '/login',
+                    data={
+                        'email': 'admin@openlabs.co.in',
+                        'password': 'password',
+                    }
+                )
+                self.assertEqual(response.status_code, 302)
+
+                response = c.get('/sales/opportunity/leads?cursor=&count=1')
+                length, count, next_cursor, prev_cursor = \
+                    response.data.split('|')
+                self.assertEqual((length, count), ('10', '25'))
+                self.assertFalse(prev_cursor)
+
+                pages = []
+                while next_cursor:
+                    response = c.get(
+                        '/sales/opportunity/leads?cursor=' + next_cursor
+                    )
+                    length, count, next_cursor, prev_cursor = \
+                        response.data.split('|')
+                    self.assertEqual(count, 'None')
+                    self.assertTrue(prev_cursor)
+                    pages.append(int(length))
+                self.assertEqual(pages, [10, 5])
+
+                # Walk back to the first page
+                response = c.get(
+                    '/sales/opportunity/leads?cursor=' + prev_cursor
+                )
+                length, count, next_cursor, prev_cursor = \
+                    response.data.split('|')
+                self.assertEqual(length, '10')
+                self.assertTrue(next_cursor)
+
+                response = c.get('/sales/opportunity/leads?cursor=garbage')
+                self.assertEqual(response.status_code, 400)
+
+                # Page numbers keep working
+                self.templates['crm/leads.jinja'] = '{{ leads|length }}'
+                response = c.get('/sales/opportunity/leads/2')
+                self.assertEqual(response.data, '25')
+
+    def test_0120_bulk_import(self):
+        """
+        Test the bulk import of leads from CSV and JSON lines
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            csv_data = '\n'.join([
+                'name,email,company,phone,website,comment',
+                'Tarun,tarun@example.com,ABC,123,www.abc.com,Hi',
+                'No Email,,XYZ,,,',
+                'Sharoon,sharoon@example.com,,,,',
+                'Extra,extra@example.com,,,,,,',
+                'N\x00ul,nul@example.com,,,,',
+                'Latin \xe9,latin@example.com,,,,',
+            ])
+            jsonl_data = '\n'.join([
+                '{"name": "Jon", "email": "jon@example.com"}',
+                '{"name": "Broken"',
+                '{"name": "Bad", "email": "bad"}',
+                '',
+                '{"name": "Arya", "email": "arya@example.com"}',
+                '{"name": "Five", "email": 5}',
+            ])
+
+            with app.test_client() as c:
+                response = c.post(
+                    '/login',
+                    data={
+                        'email': 'admin@openlabs.co.in',
+                        'password': 'password',
+                    }
+                )
+                self.assertEqual(response.status_code, 302)
+
+                response = c.post(
+                    '/sales/opportunity/-import',
+                    data=csv_data, content_type='text/csv',
+                )
+                result = json.loads(response.data)
+                self.assertEqual(result['created'], 2)
+                self.assertEqual(
+                    [e['row'] for e in result['errors']], [2, 4, 5, 6]
+                )
+
+                response = c.post(
+                    '/sales/opportunity/-import?format=jsonl',
+                    data=jsonl_data,
+                )
+                result = json.loads(response.data)
+                self.assertFalse(result['success'])
+                self.assertEqual(result['created'], 2)
+                self.assertEqual(
+                    [e['row'] for e in result['errors']], [2, 3, 5]
+                )
+
+            lead, = self.sale_opp_obj.search([
+                ('party.name', '=', 'ABC'),
+            ])
+            self.assertEqual(lead.address.name, 'Tarun')
+            self.assertEqual(lead.party.email, 'tarun@example.com')
+            self.assertEqual(lead.party.phone, '123')
+            self.assertEqual(lead.party.website, 'www.abc.com')
+            self.assertEqual(lead.employee, self.crm_admin.employee)
+            self.assertEqual(self.sale_opp_obj.search([], count=True), 4)
+
+            # Rows are created by chunks and a chunk of invalid rows does
+            # not stop the import
+            rows = [{'name': 'Bad %d' % i} for i in range(3)] + [
+                {'name': 'Good', 'email': 'good@example.com'}
+            ]
+            created, errors = self.sale_opp_obj.import_leads(
+                iter(rows), self.company.id, self.crm_admin.employee.id,
+                chunk_size=3
+            )
+            self.assertEqual(created, 1)
+            self.assertEqual([number for number, _ in errors], [1, 2, 3])
+
+            # On PostgreSQL, a chunk which cannot be created is rolled back
+            # and its rows are reported, the other chunks are imported
+            capture_leads = self.sale_opp_obj.capture_leads
+            savepoints = []
+
+            def failing_capture_leads(vlist, *args):
+                if vlist[0]['name'] == 'Fail':
+                    raise UserError('Invalid lead')
+                return capture_leads(vlist, *args)
+
+            @contextmanager
+            def savepoint(name):
+                savepoints.append(name)
+                yield
+
+            rows = [{
+                'name': name, 'email': '%s@example.com' % name.lower(),
+            } for name in ('Before', 'Fail', 'After')]
+            with patch(
+                    'trytond.modules.nereid_crm.opportunity.backend'
+                    ) as backend_, \
+                    patch.object(
+                        self.sale_opp_obj, 'capture_leads',
+                        side_effect=failing_capture_leads), \
+                    patch.object(
+                        self.sale_opp_obj, '_savepoint',
+                        staticmethod(savepoint)):
+                backend_.name.return_value = 'postgresql'
+                created, errors = self.sale_opp_obj.import_leads(
+                    iter(rows), self.company.id,
+                    self.crm_admin.employee.id, chunk_size=1
+                )
+            self.assertEqual(created, 2)
+            self.assertEqual(errors, [(2, 'Not imported: Invalid lead')])
+            self.assertEqual(len(savepoints), 3)
+
+    def test_0130_capture_leads(self):
+        """
+        Test the lead intake service outside of a request
+        """
+        ContactMech = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            lead, = self.sale_opp_obj.capture_leads([{
+                'name': 'Tarun',
+                'email': 'tarun@example.com',
+                'company': 'ABC',
+                'phone': '123',
+                'website': 'www.abc.com',
+                'comment': 'From the phone',
+                'ip_address': '127.0.0.1',
+                'detected_country': 'India',
+            }], self.company.id, self.crm_admin.employee.id, 'By phone')
+
+            self.assertEqual(lead.party.name, 'ABC')
+            self.assertEqual(lead.address.name, 'Tarun')
+            self.assertEqual(lead.address.party, lead.party)
+            self.assertEqual(lead.description, 'By phone')
+            self.assertEqual(lead.comment, 'From the phone')
+            self.assertEqual(lead.ip_address, '127.0.0.1')
+            self.assertEqual(lead.detected_country, 'India')
+            self.assertEqual(
+                ContactMech.search([('party', '=', lead.party)], count=True),
+                3
+            )
+            self.assertFalse(self.Outbox.search([]))
+
+    def test_0140_duplicate_leads(self):
+        """
+        Test that leads are attached to the party of a known email when
+        the duplicate lead policy says so
+        """
+        ContactMech = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            employee = self.crm_admin.employee.id
+
+            lead, = self.sale_opp_obj.capture_leads([{
+                'name': 'Tarun',
+                'email': ' Tarun@Example.com',
+            }], self.company.id, employee, 'First')
+            mechanism, = ContactMech.search([
+                ('party', '=', lead.party),
+                ('type', '=', 'email'),
+            ])
+            self.assertEqual(mechanism.email_normalized, 'tarun@example.com')
+            self.assertEqual(
+                ContactMech.get_parties_by_email(['TARUN@example.com']),
+                {'tarun@example.com': lead.party}
+            )
+
+            # The default policy creates a new party
+            other, = self.sale_opp_obj.capture_leads([{
+                'name': 'Tarun',
+                'email': 'tarun@example.com',
+            }], self.company.id, employee, 'Second')
+            self.assertNotEqual(other.party, lead.party)
+
+            self.Config.write(
+                [self.Config(1)], {'lead_duplicate_policy': 'attach'}
+            )
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Tarun',
+                'email': 'TARUN@example.com',
+            }, {
+                'name': 'Sharoon',
+                'email': 'sharoon@example.com',
+            }, {
+                'name': 'Sharoon',
+                'email': 'Sharoon@example.com',
+            }], self.company.id, employee, 'Third')
+            self.assertEqual(leads[0].party, lead.party)
+            self.assertEqual(leads[0].address, lead.address)
+            self.assertNotEqual(leads[1].party, lead.party)
+            self.assertEqual(leads[1].party, leads[2].party)
+            self.assertEqual(leads[1].address, leads[2].address)
+
+            # The contact of an attached lead is added to the party
+            attached, = self.sale_opp_obj.capture_leads([{
+                'name': 'Tarun B',
+                'email': 'tarun@example.com',
+                'company': 'Openlabs',
+                'phone': '+91 123',
+                'website': 'www.openlabs.co.in',
+            }], self.company.id, employee, 'Fourth')
+            self.assertEqual(attached.party, lead.party)
+            self.assertEqual(attached.address.name, 'Tarun B')
+            self.assertEqual(attached.address.party, lead.party)
+            self.assertEqual(attached.party.name, 'Tarun')
+            self.assertEqual(attached.party.phone, '+91 123')
+            self.assertEqual(attached.party.website, 'www.openlabs.co.in')
+            self.assertEqual(len(attached.party.addresses), 2)
+
+            # Known contacts are not duplicated
+            again, = self.sale_opp_obj.capture_leads([{
+                'name': 'tarun b ',
+                'email': 'tarun@example.com',
+                'phone': '+91 123',
+            }], self.company.id, employee, 'Fifth')
+            self.assertEqual(again.address, attached.address)
+            self.assertEqual(len(again.party.addresses), 2)
+            self.assertEqual(len(again.party.contact_mechanisms), 3)
+
+            # Changing the email keeps the index up to date
+            ContactMech.write([mechanism], {'value': 'new@example.com'})
+            self.assertEqual(
+                ContactMech(mechanism.id).email_normalized, 'new@example.com'
+            )
+
+            # The update only fills the normalized emails of a small table,
+            # a larger one is left to the cron
+            table = ContactMech.__table__()
+            cursor = Transaction().cursor
+
+            def email_normalized():
+                cursor.execute(*table.select(
+                    table.email_normalized, where=table.id == mechanism.id
+                ))
+                return cursor.fetchone()[0]
+
+            cursor.execute(*table.update(
+                columns=[table.email_normalized], values=[None]
+            ))
+            if not config.has_section('nereid_crm'):
+                config.add_section('nereid_crm')
+            config.set('nereid_crm', 'search_backfill_batch_size', '1')
+            try:
+                ContactMech._fill_email_normalized()
+                self.assertEqual(email_normalized(), None)
+            finally:
+                config.remove_option('nereid_crm', 'search_backfill_batch_size')
+            ContactMech.backfill_email_normalized(batch_size=1)
+            self.assertEqual(email_normalized(), 'new@example.com')
+            self.assertEqual(ContactMech.search([
+                ('email_normalized', '=', 'tarun@example.com'),
+            ], count=True), 1)
+
+            ModelData = POOL.get('ir.model.data')
+            cron = POOL.get('ir.cron')(ModelData.get_id(
+                'nereid_crm', 'cron_backfill_email_normalized'
+            ))
+            self.assertTrue(cron.active)
+            self.assertEqual(cron.number_calls, 1)
+
+    def test_0150_rate_limit(self):
+        """
+        Test the token buckets of the rate limiter and that the lead form
+        rejects the clients over the limit
+        """
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            for store in (MemoryStore(), SQLiteStore(path)):
+                def take(keys, now):
+                    # A burst of 2 and a token every 10 seconds
+                    return store.take(keys, 0.1, 2, now)
+
+                self.assertTrue(take(['ip:1', 'email:a'], 0))
+                self.assertTrue(take(['ip:1', 'email:b'], 0))
+                self.assertFalse(take(['ip:1', 'email:c'], 0))
+                # The denied request did not use the token of email:c
+                self.assertTrue(take(['ip:2', 'email:c'], 0))
+                self.assertTrue(take(['ip:1', 'email:c'], 10))
+                self.assertFalse(take(['ip:1'], 15))
+        finally:
+            os.remove(path)
+
+        self.assertTrue(RateLimiter(rate=0, store=MemoryStore()).allow('ip'))
+
+        limiter = RateLimiter(rate=1, burst=1, store=MemoryStore())
+        with Transaction().start(DB_NAME, USER, context=CONTEXT), \
+                patch(
+                    'trytond.modules.nereid_crm.opportunity.lead_rate_limiter',
+                    limiter):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                for status_code in (200, 429):
+                    response = c.post(
+                        '/sales/opportunity/-new',
+                        data={
+                            'name': 'Tarun',
+                            'email': 'demo@example.com',
+                        },
+                        headers=self.xhr_header,
+                    )
+                    self.assertEqual(response.status_code, status_code)
+            self.assertEqual(self.sale_opp_obj.search([], count=True), 1)
+
+    def test_0160_employee_users(self):
+        """
+        Test the cached mapping of the employees to their nereid user
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            employee = self.crm_admin.employee
+            employee2 = self.crm_admin2.employee
+            other, = self.Employee.create([{
+                'company': self.company.id,
+                'party': self.Party.create([{'name': 'Other'}])[0].id,
+            }])
+
+            self.assertEqual(
+                self.NereidUser.get_users_for_employees(
+                    [employee, employee2.id, other]
+                ), {
+                    employee.id: self.crm_admin,
+                    employee2.id: self.crm_admin2,
+                    other.id: None,
+                }
+            )
+            self.assertEqual(
+                self.NereidUser.get_user_for_employee(employee),
+                self.crm_admin
+            )
+            self.assertIsNone(self.NereidUser.get_user_for_employee(None))
+
+            # The cache is invalidated when a user changes employee
+            self.NereidUser.write([self.crm_admin2], {'employee': other.id})
+            self.assertIsNone(
+                self.NereidUser.get_user_for_employee(employee2)
+            )
+            self.assertEqual(
+                self.NereidUser.get_user_for_employee(other),
+                self.crm_admin2
+            )
+
+            app = self.get_app()
+            self.templates['crm/leads.jinja'] = \
+                '{% for lead in leads %}' \
+                '{{ assignees[lead.employee.id].email }}{% endfor %}'
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                response = c.get('/sales/opportunity/leads')
+                self.assertEqual(response.data, 'admin@openlabs.co.in')
+
+    def test_0170_sales_team_emails(self):
+        """
+        Test the cached emails of the sales team
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.company.get_sales_team_emails(), ['admin@openlabs.co.in']
+            )
+
+            self.Company.write(
+                [self.company], {'sales_team': [('add', [self.crm_admin2])]}
+            )
+            self.assertEqual(
+                self.company.get_sales_team_emails(),
+                ['admin@openlabs.co.in', 'admin2@openlabs.co.in']
+            )
+
+            self.NereidUser.write(
+                [self.crm_admin2], {'email': 'sales@openlabs.co.in'}
+            )
+            self.NereidUser.write([self.crm_admin], {'active': False})
+            self.assertEqual(
+                self.company.get_sales_team_emails(), ['sales@openlabs.co.in']
+            )
+
+            self.Company.write(
+                [self.company], {'sales_team': [('remove', [self.crm_admin2])]}
+            )
+            self.assertEqual(self.company.get_sales_team_emails(), [])
+
+    def test_0180_mail_renderer(self):
+        """
+        Test that the mail renderer builds the same message as nereid
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.templates['crm/emails/lead_thank_you_mail.jinja'] = \
+                u'Thank you {{ lead.party.name }} \u2713'
+            app = self.get_app()
+            renderer = MailRenderer('crm/emails/lead_thank_you_mail.jinja')
+
+            with app.test_request_context('/'):
+                for i in range(2):
+                    message = message_from_string(renderer.render(
+                        'crm@openlabs.co.in', ['client@example.com'],
+                        u'Thank You for your query \u2713', lead=self.lead
+                    ))
+                    expected = message_from_string(render_email(
+                        'crm@openlabs.co.in', 'client@example.com',
+                        u'Thank You for your query \u2713',
+                        text_template='crm/emails/lead_thank_you_mail.jinja',
+                        lead=self.lead,
+                    ).as_string())
+                    self.assertEqual(
+                        sorted(message.items()), sorted(expected.items())
+                    )
+                    self.assertEqual(
+                        message.get_payload(decode=True),
+                        expected.get_payload(decode=True)
+                    )
+                    self.assertEqual(
+                        message.get_payload(decode=True).decode('utf-8'),
+                        u'Thank you abc \u2713'
+                    )
+
+    def test_0190_bulk_transition(self):
+        """
+        Test moving many leads to a state in one request
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Lead %d' % i,
+                'email': 'lead%d@example.com' % i,
+            } for i in range(4)], self.company.id,
+                self.crm_admin.employee.id, 'Bulk')
+            self.sale_opp_obj.lost([leads[0]])
+            self.sale_opp_obj.opportunity([leads[1]])
+
+            results = self.sale_opp_obj.transition_leads(
+                [lead.id for lead in leads] + [-1], 'opportunity', chunk_size=2
+            )
+            self.assertEqual(results, {
+                leads[0].id: 'invalid',
+                leads[1].id: 'unchanged',
+                leads[2].id: 'done',
+                leads[3].id: 'done',
+                -1: 'missing',
+            })
+            self.assertEqual(
+                [lead.state for lead in self.sale_opp_obj.browse(leads)],
+                ['lost', 'opportunity', 'opportunity', 'opportunity']
+            )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                response = c.post(
+                    '/sales/opportunity/-bulk-transition',
+                    data=json.dumps({
+                        'state': 'lost',
+                        'filters': {'state': 'opportunity'},
+                    }),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEqual(data['counts'], {
+                    'done': 3, 'unchanged': 0, 'invalid': 0, 'missing': 0,
+                })
+                self.assertEqual(
+                    sorted(map(int, data['results'])),
+                    sorted([lead.id for lead in leads[1:]])
+                )
+
+                response = c.post(
+                    '/sales/opportunity/-bulk-transition',
+                    data=json.dumps({'state': 'won', 'ids': [self.lead.id]}),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 400)
+
+                # The body and the filters must be objects
+                for body in (['lost'], {'state': 'lost', 'filters': 'x'}):
+                    response = c.post(
+                        '/sales/opportunity/-bulk-transition',
+                        data=json.dumps(body),
+                        content_type='application/json',
+                    )
+                    self.assertEqual(response.status_code, 400)
+
+            self.assertEqual(self.sale_opp_obj.search(
+                [('state', '=', 'lost')], count=True
+            ), 4)
+            self.assertEqual(self.lead.state, 'lead')
+
+    def test_0200_bulk_assign(self):
+        """
+        Test reassigning many leads in one request
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            employee = self.crm_admin.employee.id
+            employee2 = self.crm_admin2.employee.id
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Lead %d' % i,
+                'email': 'lead%d@example.com' % i,
+            } for i in range(4)], self.company.id, employee, 'Bulk')
+            ids = [self.lead.id] + [lead.id for lead in leads]
+
+            # Even split in the order of the leads
+            self.assertEqual(
+                self.sale_opp_obj.reassign_leads(ids, [employee2, employee]),
+                {employee2: 3, employee: 2}
+            )
+            self.assertEqual(
+                [lead.employee.id for lead in self.sale_opp_obj.browse(ids)],
+                [employee2] * 3 + [employee] * 2
+            )
+            # Nothing to split without employees
+            self.assertEqual(self.sale_opp_obj.reassign_leads(ids, []), {})
+            self.assertEqual(
+                [lead.employee.id for lead in self.sale_opp_obj.browse(ids)],
+                [employee2] * 3 + [employee] * 2
+            )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                response = c.post(
+                    '/sales/opportunity/-bulk-assign',
+                    data=json.dumps({
+                        'filters': {'name': 'Lead'},
+                        'from_user': self.crm_admin.id,
+                        'users': [self.crm_admin2.id],
+                    }),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEqual(data['count'], 2)
+                self.assertEqual(
+                    data['assigned'], {str(self.crm_admin2.id): 2}
+                )
+                self.assertEqual(self.sale_opp_obj.search(
+                    [('employee', '=', employee2)], count=True
+                ), 5)
+
+                response = c.post(
+                    '/sales/opportunity/-bulk-assign',
+                    data=json.dumps({'ids': ids, 'users': []}),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 400)
+
+                for body in ([self.crm_admin2.id], {
+                        'filters': ['Lead'], 'users': [self.crm_admin2.id]}):
+                    response = c.post(
+                        '/sales/opportunity/-bulk-assign',
+                        data=json.dumps(body),
+                        content_type='application/json',
+                    )
+                    self.assertEqual(response.status_code, 400)
+
+                # Users which do not exist
+                for body in ({'ids': ids, 'users': [999999]}, {
+                        'ids': ids, 'users': [self.crm_admin2.id],
+                        'from_user': 999999}):
+                    response = c.post(
+                        '/sales/opportunity/-bulk-assign',
+                        data=json.dumps(body),
+                        content_type='application/json',
+                    )
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(json.loads(response.data), {
+                        'success': False,
+                        'message': 'The leads must be assigned to employees',
+                    })
+
+    def test_0210_leads_json(self):
+        """
+        Test the JSON API of the leads
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Lead %d' % i,
+                'email': 'lead%d@example.com' % i,
+                'company': 'Company %d' % i,
+            } for i in range(3)], self.company.id,
+                self.crm_admin.employee.id, 'API')
+
+            self.assertEqual(
+                list(self.sale_opp_obj.stream_leads(
+                    [('description', '=', 'API')], len, chunk_size=2
+                )), [2, 1]
+            )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                response = c.get(
+                    '/sales/opportunity/leads.json'
+                    '?fields=id,party_name,email,state&name=Lead&per_page=2'
+                )
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEqual(data['per_page'], 2)
+                self.assertEqual(data['items'], [{
+                    'id': lead.id,
+                    'party_name': 'Company %d' % i,
+                    'email': 'lead%d@example.com' % i,
+                    'state': 'lead',
+                } for i, lead in reversed(list(enumerate(leads)))][:2])
+
+                response = c.get(
+                    '/sales/opportunity/leads.json?fields=id,password'
+                )
+                self.assertEqual(response.status_code, 400)
+
+                response = c.get(
+                    '/sales/opportunity/leads.json'
+                    '?fields=id,create_date,amount&stream=1'
+                )
+                self.assertEqual(response.status_code, 200)
+                rows = map(json.loads, response.data.splitlines())
+                self.assertEqual(
+                    [row['id'] for row in rows],
+                    [self.lead.id] + [lead.id for lead in leads]
+                )
+                self.assertEqual(
+                    rows[0]['create_date'], self.lead.create_date.isoformat()
+                )
+
+    def test_0220_export_leads(self):
+        """
+        Test the CSV export of the leads
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.sale_opp_obj.write(
+                [self.lead], {'amount': Decimal('100'), 'probability': 20}
+            )
+            lead, = self.sale_opp_obj.capture_leads([{
+                'name': u'Jos\xe9',
+                'email': 'jose@example.com',
+            }], self.company.id, self.crm_admin2.employee.id, 'Export')
+
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                response = c.get('/sales/opportunity/leads.csv')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, 'text/csv')
+                rows = list(csv.reader(StringIO(response.data)))
+                self.assertEqual(rows, [
+                    ['id', 'party_name', 'email', 'state', 'employee_name',
+                        'amount', 'probability'],
+                    [str(self.lead.id), 'abc', 'client@example.com', 'lead',
+                        'Crm Admin', '100', '20'],
+                    [str(lead.id), 'Jos\xc3\xa9', 'jose@example.com',
+                        'lead', 'Crm Admin2', '', '50'],
+                ])
+
+                response = c.get('/sales/opportunity/leads.csv?state=lost')
+                self.assertEqual(len(response.data.splitlines()), 1)
+
+    def test_0230_metrics(self):
+        """
+        Test the metrics of the handlers
+        """
+        registry.clear()
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                for i in range(3):
+                    c.get('/sales/opportunity/leads')
+                c.get('/sales/opportunity/leads.json?fields=foo')
+
+                response = c.get('/sales/-metrics')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(
+                    'nereid_crm_requests_total{handler="all_leads"} 3',
+                    response.data
+                )
+                self.assertIn(
+                    'nereid_crm_errors_total{handler="all_leads"} 0',
+                    response.data
+                )
+                self.assertIn(
+                    'nereid_crm_requests_total{handler="leads_json"} 1',
+                    response.data
+                )
+                self.assertIn(
+                    'nereid_crm_request_duration_seconds_count'
+                    '{handler="all_leads"} 3', response.data
+                )
+                self.assertIn(
+                    'nereid_crm_request_duration_seconds_bucket'
+                    '{handler="all_leads",le="+Inf"} 3', response.data
+                )
+
+            metrics = registry.handlers['all_leads']
+            self.assertTrue(metrics.queries > 0)
+            self.assertEqual(metrics.latency.count, 3)
+
+            @instrument
+            def lazy_view():
+                return LazyRenderer('crm/leads.jinja', {})
+
+            # The renderer is returned as is, to be extended, and measured
+            # until the template is rendered at the end of the request
+            with app.test_request_context('/'):
+                result = lazy_view()
+                self.assertTrue(isinstance(result, LazyRenderer))
+                self.assertNotIn('lazy_view', registry.handlers)
+                Transaction().cursor.execute('SELECT 1')
+                request_finished.send(app, response=app.response_class())
+            metrics = registry.handlers['lazy_view']
+            self.assertEqual(metrics.requests, 1)
+            self.assertEqual(metrics.queries, 1)
+            self.assertEqual(metrics.errors, 0)
+
+        histogram = Histogram([0.1, 1])
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.cumulative_counts(), [(0.1, 2), (1, 3), ('+Inf', 4)]
+        )
+
+    def test_0240_query_budgets(self):
+        """
+        Test the query budgets of the hot handlers
+        """
+        registry.clear()
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.sale_opp_obj.capture_leads([{
+                'name': 'Lead %d' % i,
+                'email': 'lead%d@example.com' % i,
+            } for i in range(20)], self.company.id,
+                self.crm_admin.employee.id, 'Budget')
+
+            # Several assignees on each page of leads
+            employees = []
+            for i in range(6):
+                user, = self.NereidUser.create([{
+                    'party': self.Party.create([{'name': 'Seller %d' % i}])[0],
+                    'display_name': 'Seller %d' % i,
+                    'email': 'seller%d@openlabs.co.in' % i,
+                    'password': 'password',
+                    'company': self.company.id,
+                }])
+                employee, = self.Employee.create([{
+                    'company': self.company.id,
+                    'party': user.party.id,
+                }])
+                self.NereidUser.write([user], {'employee': employee.id})
+                employees.append(employee)
+            leads = self.sale_opp_obj.search([('employee', '!=', None)])
+            for i, employee in enumerate(employees):
+                self.sale_opp_obj.write(
+                    leads[i::len(employees)], {'employee': employee.id}
+                )
+
+            # The cached assignees are read together, as in a new request
+            self.NereidUser.get_users_for_employees(employees)
+            invalidate_cache()
+            assignees = self.NereidUser.get_users_for_employees(employees)
+            with query_budget(1):
+                self.assertEqual(
+                    sorted(user.email for user in assignees.values()),
+                    ['seller%d@openlabs.co.in' % i for i in range(6)]
+                )
+            self.templates['crm/leads.jinja'] = \
+                '{% for lead in leads %}{{ lead.party.name }} ' \
+                '{{ assignees[lead.employee.id].email }}{% endfor %}'
+            self.templates['crm/admin-lead.jinja'] = \
+                '{{ lead.party.name }} {{ employee.email }}'
+            app = self.get_app()
+
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'admin@openlabs.co.in',
+                    'password': 'password',
+                })
+                # Warm the caches
+                c.get('/sales/opportunity/leads')
+                c.get('/sales/opportunity/lead/%d' % self.lead.id)
+
+                # A page of 10 leads reading each lead separately would
+                # exceed the budgets
+                for url, budget in (
+                        ('/sales/opportunity/leads', 15),
+                        ('/sales/opportunity/leads?cursor=', 15),
+                        ('/sales/opportunity/leads?name=Lead', 15),
+                        ('/sales/opportunity/lead/%d' % self.lead.id, 12),
+                        ('/sales', 15),
+                        ):
+                    with query_budget(budget) as profiler:
+                        response = c.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue(profiler.count > 0)
+
+                with self.assertRaises(QueryBudgetExceeded):
+                    with query_budget(1):
+                        c.get('/sales/opportunity/leads')
+
+                response = c.get('/sales/-metrics/queries')
+                slowest = json.loads(response.data)['all_leads']
+                self.assertTrue(0 < len(slowest) <= 10)
+                self.assertTrue(all(
+                    first['duration'] >= second['duration']
+                    for first, second in zip(slowest, slowest[1:])
+                ))
+
+    def test_0250_composite_indexes(self):
+        """
+        Test the indexes of the queries of the CRM
+        """
+        TableHandler = backend.get('TableHandler')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            cursor = Transaction().cursor
+            table = TableHandler(cursor, self.sale_opp_obj, 'nereid_crm')
+
+            for columns in self.sale_opp_obj._composite_indexes:
+                self.assertTrue(
+                    'sale_opportunity_%s_index' % '_'.join(columns)
+                    in table._indexes, columns
+                )
+
+            # A dropped index is created again by the update
+            table.index_action(['employee', 'state'], 'remove')
+            self.assertFalse(
+                'sale_opportunity_employee_state_index' in table._indexes
+            )
+            self.sale_opp_obj._create_composite_indexes('nereid_crm', True)
+            table = TableHandler(cursor, self.sale_opp_obj, 'nereid_crm')
+            self.assertTrue(
+                'sale_opportunity_employee_state_index' in table._indexes
+            )
+
+    def test_0260_lead_search_columns(self):
+        """
+        Test the search columns of the leads
+        """
+        Party = POOL.get('party.party')
+        Address = POOL.get('party.address')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        def search_columns(lead):
+            lead = self.sale_opp_obj(lead.id)
+            return (lead.search_company, lead.search_name, lead.search_email)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            lead = self.lead
+            self.assertEqual(
+                search_columns(lead), ('abc', 'abc', 'client@example.com')
+            )
+
+            # The columns follow the party, address and contact mechanisms
+            Party.write([lead.party], {'name': ' Openlabs '})
+            Address.write([lead.address], {'name': 'John DOE'})
+            email, = lead.party.contact_mechanisms
+            ContactMechanism.write([email], {'value': 'John@Example.com'})
+            self.assertEqual(
+                search_columns(lead),
+                ('openlabs', 'john doe', 'john@example.com')
+            )
+
+            ContactMechanism.write([email], {'active': False})
+            self.assertEqual(search_columns(lead)[2], None)
+            ContactMechanism.create([{
+                'type': 'phone',
+                'party': lead.party.id,
+                'value': '+1 555 0100',
+            }, {
+                'type': 'email',
+                'party': lead.party.id,
+                'value': 'sales@example.com',
+            }])
+            self.assertEqual(search_columns(lead)[2], 'sales@example.com')
+            ContactMechanism.delete(ContactMechanism.search([
+                ('party', '=', lead.party.id),
+                ('type', '=', 'email'),
+            ]))
+            self.assertEqual(search_columns(lead)[2], None)
+
+            # And the lead
+            party, = Party.create([{
+                'name': 'XYZ',
+                'addresses': [('create', [{'name': 'Jane'}])],
+                'contact_mechanisms': [('create', [{
+                    'type': 'email', 'value': 'jane@xyz.com',
+                }])],
+            }])
+            self.sale_opp_obj.write([lead], {
+                'party': party.id,
+                'address': party.addresses[0].id,
+            })
+            self.assertEqual(
+                search_columns(lead), ('xyz', 'jane', 'jane@xyz.com')
+            )
+
+            # The backfill restores cleared columns in batches
+            leads = self.sale_opp_obj.capture_leads([{
+                'name': 'Lead %d' % i,
+                'company': 'Company %d' % i,
+                'email': 'lead%d@example.com' % i,
+            } for i in range(3)], self.company.id,
+                self.crm_admin.employee.id, 'Backfill')
+            table = self.sale_opp_obj.__table__()
+            Transaction().cursor.execute(*table.update(
+                columns=[
+                    table.search_company, table.search_name,
+                    table.search_email,
+                ], values=[None, None, None]
+            ))
+            self.sale_opp_obj.backfill_search_columns(batch_size=2)
+            self.assertEqual(
+                search_columns(leads[2]),
+                ('company 2', 'lead 2', 'lead2@example.com')
+            )
+            self.assertEqual(
+                search_columns(lead), ('xyz', 'jane', 'jane@xyz.com')
+            )
+
+            # The update only fills the search columns of a small table,
+            # a larger one is left to the cron
+            cursor = Transaction().cursor
+
+            def search_company():
+                cursor.execute(*table.select(
+                    table.search_company, where=table.id == lead.id
+                ))
+                return cursor.fetchone()[0]
+
+            cursor.execute(*table.update(
+                columns=[table.search_company], values=[None]
+            ))
+            if not config.has_section('nereid_crm'):
+                config.add_section('nereid_crm')
+            config.set('nereid_crm', 'search_backfill_batch_size', '3')
+            try:
+                self.sale_opp_obj._fill_new_search_columns()
+                self.assertEqual(search_company(), None)
+            finally:
+                config.remove_option('nereid_crm', 'search_backfill_batch_size')
+            self.sale_opp_obj._fill_new_search_columns()
+            self.assertEqual(search_company(), 'xyz')
+
+            # The cron of the larger tables runs once on its own
+            ModelData = POOL.get('ir.model.data')
+            cron = POOL.get('ir.cron')(ModelData.get_id(
+                'nereid_crm', 'cron_backfill_search_columns'
+            ))
+            self.assertTrue(cron.active)
+            self.assertEqual(cron.number_calls, 1)
+            self.assertEqual(cron.function, 'backfill_search_columns')
+
+            # The filters do not depend on the case
+            self.assertEqual(self.sale_opp_obj.search_count(
+                self.sale_opp_obj._get_leads_filter_domain({
+                    'company': 'COMPANY ', 'name': 'Lead', 'email': '@EXA',
+                })
+            ), 3)
+
+    def login(self, client):
+        response = client.post('/login', data={
+            'email': 'admin@openlabs.co.in',
+            'password': 'password',
+        })
+        self.assertEqual(response.status_code, 302)
+
+    def test_0270_comment_count(self):
+        """
+        Test the comment count of the leads
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.templates['crm/admin-lead.jinja'] = \
+                '{{ comments|length }}'
+            lead = self.lead
+            self.assertEqual(lead.comment_count, 0)
+
+            # A lead without comment does not search its reviews
+            self.assertEqual(lead.get_comments(limit=10), [])
+            app = self.get_app()
+            with app.test_client() as client:
+                self.login(client)
+                response = client.get(
+                    '/sales/opportunity/lead/%d' % lead.id
+                )
+                self.assertEqual(response.data, '0')
+                response = client.get(
+                    '/sales/opportunity/lead/%d/comments.json' % lead.id
+                )
+                self.assertEqual(json.loads(response.data), {
+                    'page': 1, 'per_page': 10, 'count': 0, 'items': [],
+                })
+
+            self.sale_opp_obj.increment_comment_count([lead])
+            self.assertEqual(self.sale_opp_obj(lead.id).comment_count, 1)
+            self.sale_opp_obj.increment_comment_count([lead], 2)
+            self.assertEqual(self.sale_opp_obj(lead.id).comment_count, 3)
+
+    def test_0280_lead_comments(self):
+        """
+        Test the paginated comments of a lead
+        """
+        Review = POOL.get('nereid.review')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_test_lead()
+            self.templates['crm/admin-lead.jinja'] = \
+                '{% for comment in comments %}{{ comment.title }} ' \
+                '{% endfor %}'
+            lead = self.lead
+            app = self.get_app()
+            with app.test_client() as client:
+                self.login(client)
+                for i in range(12):
+                    response = client.post(
+                        '/sales/opportunity/lead/add-comment', data={
+                            'lead': lead.id,
+                            'title': 'Call %d' % i,
+                            'comment': 'Called the lead',
+                        }, headers=self.xhr_header
+                    )
+                    self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    self.sale_opp_obj(lead.id).comment_count, 12
+                )
+
+                # The latest comments are rendered with the lead
+                response = client.get(
+                    '/sales/opportunity/lead/%d' % lead.id
+                )
+                self.assertEqual(
+                    response.data.strip(),
+                    ' '.join('Call %d' % i for i in range(11, 1, -1))
+                )
+
+                # And the older ones are paginated
+                response = client.get(
+                    '/sales/opportunity/lead/%d/comments.json'
+                    '?page=3&per_page=5' % lead.id
+                )
+                data = json.loads(response.data)
+                self.assertEqual(data['count'], 12)
+                self.assertEqual(
+                    [item['title'] for item in data['items']],
+                    ['Call 1', 'Call 0']
+                )
+                self.assertEqual(
+                    set(data['items'][0]),
+                    set(self.sale_opp_obj._comment_api_fields)
+                )
+                self.assertEqual(
+                    data['items'][0]['author'], self.crm_admin.rec_name
+                )
+
+            # The count follows the reviews created, moved and deleted
+            # outside of add_comment
+            other_lead, = self.sale_opp_obj.copy([lead])
+            self.assertEqual(other_lead.comment_count, 12)
+            review, = Review.create([{
+                'lead': lead.id,
+                'title': 'Meeting',
+                'nereid_user': self.crm_admin.id,
+                'party': lead.party.id,
+            }])
+            self.assertEqual(self.sale_opp_obj(lead.id).comment_count, 13)
+            self.assertEqual(
+                self.sale_opp_obj(lead.id).get_comments(limit=1), [review]
+            )
+            Review.write([review], {'lead': other_lead.id})
+            self.assertEqual(self.sale_opp_obj(lead.id).comment_count, 12)
+            self.assertEqual(
+                self.sale_opp_obj(other_lead.id).get_comments(limit=1),
+                [review]
+            )
+            Review.delete(Review.search([('lead', '=', lead.id)]))
+            self.assertEqual(self.sale_opp_obj(lead.id).comment_count, 0)
+            self.assertEqual(
+                self.sale_opp_obj(other_lead.id).comment_count, 13
+            )
+
+    def get_stream_after_transaction(self, url):
+        """
+        Return the body of the streamed response of the url, read once the
+        transaction of the request has stopped, like nereid does outside of
+        the tests
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            with app.test_client() as client:
+                self.login(client)
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Transaction().cursor)
+        return response.data
+
+    def test_0290_leads_json_stream(self):
+        """
+        Test the stream of the leads once the transaction has stopped
+        """
+        # The stream reads in its own transaction, where the leads of the
+        # rolled back transaction do not exist
+        self.assertEqual(self.get_stream_after_transaction(
+            '/sales/opportunity/leads.json?stream=1'
+        ), '')
+
+    def test_0300_export_leads_stream(self):
+        """
+        Test the CSV export once the transaction has stopped
+        """
+        self.assertEqual(self.get_stream_after_transaction(
+            '/sales/opportunity/leads.csv'
+        ).splitlines(), [','.join(self.sale_opp_obj._csv_columns)])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    test_smtp_pool
+
+    Test suite for the SMTP connection pool
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import smtpd
+import smtplib
+import asyncore
+import unittest
+import threading
+
+from mock import MagicMock
+
+from trytond.modules.nereid_crm.smtp_pool import SMTPConnectionPool, \
+    PoolTimeout
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """
+    A local SMTP server which records the messages and the number of
+    connections it accepted
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class SMTPPoolTestCase(unittest.TestCase):
+    '''
+    Test the SMTP connection pool
+    '''
+
+    def get_connection(self):
+        connection = MagicMock()
+        connection.noop.return_value = (250, 'OK')
+        return connection
+
+    def test_0010_reuse_connection(self):
+        """
+        Test that idle connections are reused
+        """
+        factory = MagicMock(side_effect=self.get_connection)
+        pool = SMTPConnectionPool(factory, max_size=2)
+
+        for i in range(10):
+            pool.sendmail('from@example.com', ['to@example.com'], 'msg')
+
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual(pool.size, 1)
+
+        # A connection used a moment ago is not checked
+        connection = pool.acquire()
+        self.assertFalse(connection.noop.called)
+
+    def test_0020_reconnect(self):
+        """
+        Test that broken and stale connections are replaced
+        """
+        factory = MagicMock(side_effect=self.get_connection)
+        pool = SMTPConnectionPool(factory, max_size=2)
+
+        connection = pool.acquire()
+        pool.release(connection)
+
+        # Failed health check of a connection idle for a while
+        pool.check_after = 0
+        connection.noop.return_value = (421, 'Bye')
+        new_connection = pool.acquire()
+        self.assertNotEqual(new_connection, connection)
+        self.assertEqual(factory.call_count, 2)
+        self.assertEqual(pool.size, 1)
+        pool.release(new_connection)
+
+        # Disconnected while sending
+        connection = new_connection
+        connection.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        pool.sendmail('from@example.com', ['to@example.com'], 'msg')
+        self.assertEqual(factory.call_count, 3)
+        self.assertEqual(pool.size, 1)
+
+        # Idle timeout
+        pool.idle_timeout = 0
+        pool.close_idle()
+        self.assertEqual(pool.size, 0)
+
+    def test_0030_bounded(self):
+        """
+        Test that the pool does not open more than max_size connections
+        """
+        pool = SMTPConnectionPool(
+            self.get_connection, max_size=2, wait_timeout=0.1
+        )
+        first = pool.acquire()
+        pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire)
+
+        pool.release(first)
+        self.assertEqual(pool.acquire(), first)
+
+    def test_0040_throughput(self):
+        """
+        Send a burst of mails from several threads to a local SMTP server
+        """
+        server = StandInSMTPServer()
+        host, port = server.socket.getsockname()
+        loop = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.01}
+        )
+        loop.start()
+
+        pool = SMTPConnectionPool(
+            lambda: smtplib.SMTP(host, port), max_size=3
+        )
+
+        def send():
+            for i in range(20):
+                pool.sendmail(
+                    'from@example.com', ['to@example.com'], 'Subject: %d' % i
+                )
+        try:
+            workers = [threading.Thread(target=send) for i in range(6)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            pool.close_all()
+        finally:
+            asyncore.close_all()
+            loop.join()
+
+        self.assertEqual(len(server.messages), 120)
+        self.assertTrue(server.connections <= 3)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        SMTPPoolTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
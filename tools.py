@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+    tools
+
+    Helpers shared by the models of the CRM
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+from trytond.transaction import Transaction
+
+
+__all__ = ['invalidate_cache']
+
+
+def invalidate_cache(model_name=None, ids=None):
+    """
+    Forget the records read in the transaction after they were changed in
+    SQL, bypassing the cache maintenance of the ORM.
+
+    :param model_name: The model of the records, all the models if None
+    :param ids: The ids of the records, all the records of the model if
+                None
+    """
+    transaction = Transaction()
+    # Clears the local caches of the instances already browsed
+    transaction.counter += 1
+    for cache in transaction.cursor.cache.itervalues():
+        if model_name is None:
+            cache.clear()
+        elif ids is None:
+            cache.pop(model_name, None)
+        elif model_name in cache:
+            for id in ids:
+                cache[model_name].pop(id, None)